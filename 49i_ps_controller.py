@@ -1,17 +1,26 @@
 import argparse
+import concurrent.futures
 import csv
 import os
+import queue
 import signal
 import sys
 import threading
 import time
-from datetime import datetime, timezone
+from collections import deque
+from datetime import datetime
+from itertools import islice
 
-import matplotlib.pyplot as plt
+import numpy as np
 import polars as pl
 import yaml
-from flask import Flask, jsonify, render_template_string
-from scipy.stats import linregress
+from flask import Flask, Response, jsonify, render_template_string
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from instr.thermo import Thermo49i
 from utils.logging_config import setup_logging
@@ -31,6 +40,15 @@ from utils.utils import load_config
 #     with open(yaml_file, 'r') as f:
 #         return yaml.safe_load(f)
 
+# ---------------- JSON serialization ------------------
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider serializing with orjson."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # ---------------- Data Logger and Plotter ------------------
 class InstrumentController:
     def __init__(self, config_path, calibrator, values, duration,
@@ -40,8 +58,9 @@ class InstrumentController:
 
         self.config = load_config(config_path)
 
+        self._root = os.path.expanduser(self.config['paths']['root'])
+
         # setup logging
-        logfile = os.path.join(os.path.expanduser(self.config['paths']['root']), self.config['logging']['file_name'])
         self.logger = setup_logging(self.config)
 
         # Get calibrator name, IP, levels, duration
@@ -56,17 +75,33 @@ class InstrumentController:
         self.analyzer_name = self.analyzer.name
         # self.analyzer_ip = self.analyzer._sockaddr
 
-        self.output_csv = output_csv or os.path.join(os.path.expanduser(self.config['paths']['root']), self.config['paths']['data'], f"ozone_comparison-{datetime.now().strftime('%Y%m%d%H%M')}.csv")
+        self.output_csv = output_csv or os.path.join(self._root, self.config['paths']['data'], f"ozone_comparison-{datetime.now().strftime('%Y%m%d%H%M')}.csv")
         os.makedirs(os.path.dirname(self.output_csv), exist_ok=True)
 
         self.running = False
-        self.data = []  # list of dicts with dtm and readings
+        # bounded window of (dtm, level, calibrator, analyzer) rows for the dashboard; the CSV file is the durable record
+        self.data = deque(maxlen=self.config.get('dashboard_window', 1000))
+
+        # read interval in seconds
+        self.interval = 5.0
+        self._next_tick = None
 
-        # CSV writer thread-safe setup
-        self.csv_lock = threading.Lock()
+        # number of rows buffered before the CSV file is flushed to disk (~5 minutes)
+        self.flush_rows = 60
+
+        # thread pool to query calibrator and analyzer concurrently
+        self._io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="instr")
+
+        # one queue per connected dashboard, fed by log_data. Each /stream connection holds a server thread
+        # for as long as it is open, so their number is capped below the size of the server's thread pool.
+        self._subscribers = set()
+        self._subscribers_lock = threading.Lock()
+        self.max_streams = self.config.get('dashboard_streams', 8)
 
         # Flask app setup
         self.app = Flask(__name__)
+        if orjson is not None:
+            self.app.json = OrjsonProvider(self.app)
         self._setup_routes()
         self.flask_thread = threading.Thread(target=self._run_flask)
         self.flask_thread.daemon = True
@@ -85,19 +120,24 @@ class InstrumentController:
                 <h2>Live Instrument Data</h2>
                 <div id="plot" style="width:100%;height:80vh;"></div>
                 <script>
-                    function fetchData() {
-                        fetch('/data').then(res => res.json()).then(data => {
-                            const layout = {title: 'Live Instrument Values', xaxis: {title: 'Time'}, yaxis: {title: 'ppb'}};
-                            const plotData = [
-                                {x: data.timestamps, y: data.level, name: 'level', type: 'scatter'},
-                                {x: data.timestamps, y: data.calibrator_values, name: data.calibrator_name, type: 'scatter'},
-                                {x: data.timestamps, y: data.analyzer_values, name: data.analyzer_name, type: 'scatter'}
-                            ];
-                           <!-- Plotly.newPlot('plot', plotData, layout); -->
-                        });
-                    }
-                    setInterval(fetchData, 5000);
-                    fetchData();
+                    const layout = {title: 'Live Instrument Values', xaxis: {title: 'Time'}, yaxis: {title: 'ppb'}};
+                    fetch('/data').then(res => res.json()).then(data => {
+                        const plotData = [
+                            {x: data.timestamps, y: data.level, name: 'level', type: 'scatter'},
+                            {x: data.timestamps, y: data.calibrator_values, name: data.calibrator_name, type: 'scatter'},
+                            {x: data.timestamps, y: data.analyzer_values, name: data.analyzer_name, type: 'scatter'}
+                        ];
+                        Plotly.newPlot('plot', plotData, layout);
+
+                        // receive one new row per read interval
+                        new EventSource('/stream').onmessage = ev => {
+                            const row = JSON.parse(ev.data);
+                            Plotly.extendTraces('plot', {
+                                x: [[row.dtm], [row.dtm], [row.dtm]],
+                                y: [[row.level], [row.calibrator_value], [row.analyzer_value]]
+                            }, [0, 1, 2], 100);
+                        };
+                    });
                 </script>
             </body>
             </html>
@@ -105,39 +145,125 @@ class InstrumentController:
 
         @self.app.route('/data')
         def data():
-            timestamps = [row['dtm'] for row in self.data[-100:]]
-            calibrator_values = [row[self.calibrator_name] for row in self.data[-100:]]
-            analyzer_values = [row[self.analyzer_name] for row in self.data[-100:]]
+            window = list(islice(self.data, max(0, len(self.data) - 100), None))
+            timestamps, level, calibrator_values, analyzer_values = (list(col) for col in zip(*window)) if window else ([], [], [], [])
             return jsonify({
                 'timestamps': timestamps,
+                'level': level,
                 'calibrator_values': calibrator_values,
                 'analyzer_values': analyzer_values,
                 'calibrator_name': self.calibrator_name,
                 'analyzer_name': self.analyzer_name
             })
 
+        @self.app.route('/stream')
+        def stream():
+            q = queue.Queue(maxsize=100)
+            with self._subscribers_lock:
+                if len(self._subscribers) >= self.max_streams:
+                    # refuse rather than starve / and /data of server threads
+                    return Response("too many dashboards connected", status=503, mimetype='text/plain')
+                self._subscribers.add(q)
+
+            def event_stream():
+                while self.running:
+                    try:
+                        msg = q.get(timeout=30)
+                    except queue.Empty:
+                        # keep-alive comment, also detects closed connections
+                        yield ": ping\n\n"
+                        continue
+                    yield f"data: {msg}\n\n"
+
+            response = Response(event_stream(), mimetype='text/event-stream')
+            # frees the slot also if the client disconnects before the stream started
+            response.call_on_close(lambda: self._subscribers.discard(q))
+            return response
+
+    def _publish(self, dtm, calibrator_value, analyzer_value):
+        """Push the latest reading to all connected dashboards."""
+        if not self._subscribers:
+            return
+        msg = self.app.json.dumps({'dtm': dtm, 'level': self.level,
+                          'calibrator_value': calibrator_value, 'analyzer_value': analyzer_value})
+        for q in list(self._subscribers):
+            try:
+                q.put_nowait(msg)
+            except queue.Full:
+                # slow client, drop the update
+                pass
+
     def _run_flask(self):
-        self.app.run(port=5000)
+        try:
+            from waitress import serve
+        except ImportError:
+            # development server without reloader; threaded, since /stream holds a connection open
+            self.app.run(host='127.0.0.1', port=5000, debug=False, use_reloader=False, threaded=True)
+        else:
+            # each /stream connection occupies a thread, keep some for / and /data
+            serve(self.app, host='127.0.0.1', port=5000, threads=self.max_streams + 4, channel_timeout=30)
 
     def stop(self, signum=None, frame=None):
         print("\nGracefully stopping...")
         self.running = False
+        self._io_pool.shutdown(wait=False, cancel_futures=True)
 
     def log_data(self):
-        with open(self.output_csv, 'w', newline='') as csvfile:
-            fieldnames = ['dtm', 'level', self.calibrator_name, self.analyzer_name]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-
+        with open(self.output_csv, 'w', newline='', buffering=1 << 16) as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['dtm', 'level', self.calibrator_name, self.analyzer_name])
+
+            rows_since_flush = 0
+            # futures of the last reads of calibrator and analyzer, until they completed
+            pending = None
+            self._next_tick = time.monotonic()
             while self.running:
-                dtm = datetime.now(tz=timezone.utc).isoformat(timespec="seconds")
-                calibrator_value = self.calibrator.get_o3()
-                analyzer_value = self.analyzer.get_o3()
-                row = {'dtm': dtm, 'level': self.level, self.analyzer_name: analyzer_value, self.calibrator_name: calibrator_value}
-                with self.csv_lock:
-                    writer.writerow(row)
+                # sleep until the next tick on a drift-free monotonic grid
+                self._next_tick += self.interval
+                dt = self._next_tick - time.monotonic()
+                if dt > 0:
+                    time.sleep(dt)
+                else:
+                    self.logger.warning(f"Read cycle overran by {-dt:.3f} s, dropped frame.")
+                    self._next_tick = time.monotonic()
+                if not self.running:
+                    break
+
+                # don't queue another read on top of one that is still waiting for an instrument
+                if pending is not None and not all(future.done() for future in pending):
+                    self.logger.warning("Previous instrument read still in progress, sample skipped.")
+                    continue
+                try:
+                    fc = self._io_pool.submit(self.calibrator.get_o3)
+                    fa = self._io_pool.submit(self.analyzer.get_o3)
+                except RuntimeError:
+                    # pool was shut down by stop()
+                    break
+                pending = (fc, fa)
+                dtm = time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime())
+
+                # one deadline for both reads
+                _, not_done = concurrent.futures.wait(pending, timeout=0.9 * self.interval)
+                if not_done:
+                    self.logger.warning("Instrument read timed out, sample skipped.")
+                    continue
+                pending = None
+                try:
+                    calibrator_value, analyzer_value = fc.result(), fa.result()
+                except Exception as err:
+                    self.logger.error(f"Instrument read failed, sample skipped: {err}")
+                    continue
+                # same column order as the header
+                row = (dtm, self.level, calibrator_value, analyzer_value)
+                # only this thread writes to the CSV file, no lock needed
+                writer.writerow(row)
+                rows_since_flush += 1
+                if rows_since_flush >= self.flush_rows:
+                    csvfile.flush()
+                    os.fsync(csvfile.fileno())
+                    rows_since_flush = 0
                 self.data.append(row)
-                time.sleep(5)  # read interval in seconds
+                self._publish(dtm, calibrator_value, analyzer_value)
 
             print("Logging stopped. Final data written to CSV.")
 
@@ -148,11 +274,12 @@ class InstrumentController:
                 break
             # set_value(self.calibrator_ip, value)
             self.level = self.calibrator.set_o3(value)
-            steps = int(self.duration * 60 / 5)
-            for _ in range(steps):
-                if not self.running:
+            end = time.monotonic() + self.duration * 60
+            while self.running:
+                dt = end - time.monotonic()
+                if dt <= 0:
                     break
-                time.sleep(5)
+                time.sleep(min(dt, self.interval))
 
         self.running = False
 
@@ -172,20 +299,22 @@ class InstrumentController:
         self.plot_data()
 
     def plot_data(self):
-        df = pl.DataFrame(self.data)
+        # heavy imports, only needed once the experiment is finished
+        import matplotlib.pyplot as plt
+        from scipy.stats import linregress
+
+        # the CSV written by log_data is the complete record of the experiment
+        df = pl.read_csv(self.output_csv, try_parse_dates=True)
         diff_col = f"{self.analyzer_name}-{self.calibrator_name}"
-        df = df.with_columns([
-            pl.col("dtm").str.to_datetime(),
+        df = df.with_columns(
             (pl.col(self.analyzer_name) - pl.col(self.calibrator_name)).alias(diff_col)
-        ])
-
-        df.write_csv(self.output_csv)  # Overwrite with difference column
-        diff_plot_df = df.select(["dtm", self.analyzer_name, self.calibrator_name, diff_col]).to_pandas()
+        )
+        dtm = df['dtm'].to_numpy()
 
     #     # Time series plot
         plt.figure()
         for col in [self.calibrator_name, self.analyzer_name]:
-            plt.plot(diff_plot_df['dtm'], diff_plot_df[col], label=col)
+            plt.plot(dtm, df[col].to_numpy(), label=col)
         plt.xlabel('Time')
         plt.ylabel('Value (ppb)')
         plt.title('Instrument Readings Over Time')
@@ -197,7 +326,7 @@ class InstrumentController:
 
     #     # Difference plot
         plt.figure()
-        plt.plot(diff_plot_df['dtm'], diff_plot_df['difference'], label='Difference')
+        plt.plot(dtm, df[diff_col].to_numpy(), label='Difference')
         plt.xlabel('Time')
         plt.ylabel('Difference (ppb)')
         plt.title('Difference Between Instruments')
@@ -207,9 +336,10 @@ class InstrumentController:
         plt.show()
 
         # Regression analysis
-        slope, intercept, r_value, p_value, std_err = linregress(
-            diff_plot_df[self.calibrator_name], diff_plot_df[self.analyzer_name]
-        )
+        x = df[self.calibrator_name].to_numpy().astype(float)
+        y = df[self.analyzer_name].to_numpy().astype(float)
+        valid = ~(np.isnan(x) | np.isnan(y))
+        slope, intercept, r_value, p_value, std_err = linregress(x[valid], y[valid])
 
         results_text = (
             f"Linear regression between {self.calibrator_name} (x) and {self.analyzer_name} (y):\n"
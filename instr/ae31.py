@@ -1,14 +1,46 @@
+import glob
 import logging
 import os
 import shutil
+import sys
+import time
 import zipfile
 from datetime import datetime
 
 import colorama
 import polars as pl
-import schedule
 import serial
 
+from utils.scheduler import PeriodicScheduler
+
+# ANSI colors need translating only on Windows consoles
+if sys.platform == 'win32':
+    colorama.init(autoreset=True)
+
+# columns of the .csv files written by AE31.accumulate_data and their types
+_CSV_COLUMNS = ["dtm","unknown","date","time","UV370","B470","G520","Y590","R660","IR880","IR950","flow",]# "bypass",]
+_CSV_COLUMNS += ["?370", "sens_zero_370","sens_beam_370","ref_zero_370","ref_beam_370","att_370", ]#"flow_370", "bypass_370",] 
+_CSV_COLUMNS += ["?470", "sens_zero_470","sens_beam_470","ref_zero_470","ref_beam_470","att_470", ]#"flow_470", "bypass_470",] 
+_CSV_COLUMNS += ["?520", "sens_zero_520","sens_beam_520","ref_zero_520","ref_beam_520","att_520", ]#"flow_520", "bypass_520",] 
+_CSV_COLUMNS += ["?590", "sens_zero_590","sens_beam_590","ref_zero_590","ref_beam_590","att_590", ]#"flow_590", "bypass_590",] 
+_CSV_COLUMNS += ["?660", "sens_zero_660","sens_beam_660","ref_zero_660","ref_beam_660","att_660", ]#"flow_660", "bypass_660",] 
+_CSV_COLUMNS += ["?880", "sens_zero_880","sens_beam_880","ref_zero_880","ref_beam_880","att_880", ]#"flow_880", "bypass_880",] 
+_CSV_COLUMNS += ["?950", "sens_zero_950","sens_beam_950","ref_zero_950","ref_beam_950","att_950", ]#"flow_950", "bypass_950",]
+_CSV_SCHEMA = {col: (pl.String if col in ("dtm", "date", "time") else pl.Float32) for col in _CSV_COLUMNS}
+
+
+# header of the .csv files written by AE31._save_data
+_HEADER = ",".join([
+    "dtm", "id", "date", "time", "UV370", "B470", "G520", "Y590", "R660", "IR880", "IR950", "flow",
+    "UV370_1", "UV370_2", "UV370_3", "UV370_4", "", "UV370_5", "UV370_6",
+    "B470_1", "B470_2", "B470_3", "B470_4", "", "B470_5", "B470_6",
+    "G520_1", "G520_2", "G520_3", "G520_4", "", "G520_5", "G520_6",
+    "Y590_1", "Y590_2", "Y590_3", "Y590_4", "", "Y590_5", "Y590_6",
+    "R660_1", "R660_2", "R660_3", "R660_4", "", "R660_5", "R660_6",
+    "IR880_1", "IR880_2", "IR880_3", "IR880_4", "", "IR880_5", "IR880_6",
+    "IR950_1", "IR950_2", "IR950_3", "IR950_4", "", "IR950_5", "IR950_6",
+]) + "\n"
+
 
 class AE31:
     def __init__(self, config: dict):
@@ -17,8 +49,6 @@ class AE31:
         Args:
             config (dict): general configuration
         """
-        colorama.init(autoreset=True)
-
         try:
             # configure logging
             _logger = f"{os.path.basename(config['logging']['file'])}".split('.')[0]
@@ -28,31 +58,23 @@ class AE31:
             # configure serial port
             self._serial_port = config['AE31']['serial_port']
             self._serial_timeout = config['AE31']['serial_timeout']
+            self._ser = None
             
-            root = os.path.expanduser(config['root'])
+            self._root = os.path.expanduser(config['root'])
 
             # configure data collection and saving
             self.sampling_interval = int(config['AE31']['sampling_interval'])
             self.reporting_interval = int(config['AE31']['reporting_interval'])
             if not (self.reporting_interval % 60)==0 and self.reporting_interval<=1440:
                 raise ValueError('reporting_interval must be a multiple of 60 and less or equal to 1440 minutes.')
-            header = "dtm,id,date,time,UV370,B470,G520,Y590,R660,IR880,IR950,flow"
-            header = f"{header},UV370_1,UV370_2,UV370_3,UV370_4,,UV370_5,UV370_6"
-            header = f"{header},B470_1,B470_2,B470_3,B470_4,,B470_5,B470_6"
-            header = f"{header},G520_1,G520_2,G520_3,G520_4,,G520_5,G520_6"
-            header = f"{header},Y590_1,Y590_2,Y590_3,Y590_4,,Y590_5,Y590_6"
-            header = f"{header},R660_1,R660_2,R660_3,R660_4,,R660_5,R660_6"
-            header = f"{header},IR880_1,IR880_2,IR880_3,IR880_4,,IR880_5,IR880_6"
-            header = f"{header},IR950_1,IR950_2,IR950_3,IR950_4,,IR950_5,IR950_6\n"
-            self.header = header
-
-            self.data_path = os.path.join(root, config['data'], config['AE31']['data_path'])
-            os.makedirs(self.data_path, exist_ok=True)
+            self.header = _HEADER
+
+            self.data_path = os.path.join(self._root, config['data'], config['AE31']['data_path'])
             # schedule.every(int(self.sampling_interval)).minutes.at(':00').do(self.accumulate_data)
             # schedule.every(int(self.sampling_interval)).minutes.at(':01').do(self._save_data)
                      
             # configure staging
-            self.staging_path = os.path.join(root, config['staging'], config['AE31']['staging_path'])
+            self.staging_path = os.path.join(self._root, config['staging'], config['AE31']['staging_path'])
             # os.makedirs(self.staging_path, exist_ok=True)
             # if self.reporting_interval==1440:
             #     schedule.every(1).day.at('00:00:05').do(self._save_and_stage_data)
@@ -66,11 +88,19 @@ class AE31:
             # configure remote transfer
             self.remote_path = config['AE31']['remote_path']
 
-            # initialize data response and datetime stamp           
-            self._data = str()
+            # initialize data response, one line per record, and datetime stamp
+            self._data = []
             self.data_file = str()
             self._dtm = None
 
+            # background scheduler, see setup_schedules
+            self._scheduler = None
+            self._file_timestamp_format = str()
+
+            # handle of the data file currently written to
+            self._fh = None
+            self._current_file = None
+
         except Exception as err:
             self.logger.error(err)
             pass
@@ -79,45 +109,73 @@ class AE31:
     def setup_schedules(self):
         try:
             # configure folders needed
-            os.makedirs(self.data_path, exist_ok=True)
-            os.makedirs(self.staging_path, exist_ok=True)
-            # os.makedirs(self.archive_path, exist_ok=True)
+            for path in (self.data_path, self.staging_path):
+                os.makedirs(path, exist_ok=True)
+
+            self._scheduler = PeriodicScheduler(name="AE31")
 
             # configure data acquisition schedule
-            schedule.every(self.sampling_interval).minutes.at(':00').do(self.accumulate_data)
-            
+            self._scheduler.every(self.sampling_interval * 60, 0, self.accumulate_data)
+
             # configure saving and staging schedules
             if self.reporting_interval==10:
                 self._file_timestamp_format = '%Y%m%d%H%M'
-                minutes = [f"{self.reporting_interval*n:02}" for n in range(6) if self.reporting_interval*n < 6]
-                for minute in minutes:
-                    schedule.every(1).hour.at(f"{minute}:01").do(self._save_and_stage_data)
             elif self.reporting_interval==60:
                 self._file_timestamp_format = '%Y%m%d%H'
-                schedule.every(1).hour.at('00:01').do(self._save_and_stage_data)
             elif self.reporting_interval==1440:
                 self._file_timestamp_format = '%Y%m%d'
-                schedule.every(1).day.at('00:00:01').do(self._save_and_stage_data)
+            if self._file_timestamp_format:
+                self._scheduler.every(self.reporting_interval * 60, 1, self._save_and_stage_data)
+
+            self._scheduler.start()
 
         except Exception as err:
             self.logger.error(err)
 
 
+    def _open_serial(self) -> serial.Serial:
+        """Return the serial port, opening it on first use or after an error. The port is kept open between reads."""
+        if self._ser is None or not self._ser.is_open:
+            self._ser = serial.Serial(self._serial_port, 9600, 8, 'N', 1, int(self._serial_timeout))
+        return self._ser
+
+
+    def _close_serial(self):
+        """Close the serial port."""
+        if self._ser is not None:
+            self._ser.close()
+            self._ser = None
+
+
+    def close(self):
+        """Stop the background scheduler, close the data file and the serial port."""
+        if self._scheduler is not None:
+            self._scheduler.stop()
+            self._scheduler.join()
+        self._close_data_file()
+        self._close_serial()
+
+
     def accumulate_data(self):
         """
-        Read data waiting at serial port. Opens the port, assigns lines read to self._data.
+        Read data waiting at serial port. Appends lines read to self._data.
         """
         try:
-            with serial.Serial(self._serial_port, 9600, 8, 'N', 1, int(self._serial_timeout)) as ser:
-                self._dtm = datetime.now().isoformat(timespec='seconds')
-                _ = f"{self._dtm},{ser.readline().decode('ascii').strip()}\n"
-                self._data = f"{self._data}{_}"
+            ser = self._open_serial()
+            line = ser.readline()
+            while line:
+                self._dtm = time.strftime('%Y-%m-%dT%H:%M:%S')
+                _ = f"{self._dtm},{line.decode('ascii').strip()}\n"
+                self._data.append(_)
                 self.logger.info(f"AE31, {_[:60]} [...]"),
+                # drain any further complete lines buffered since the last read
+                line = ser.readline() if ser.in_waiting else b''
             return
 
         except serial.SerialException as err:
             self.logger.error(f"SerialException: {err}")
-            pass
+            # reopen on next call
+            self._close_serial()
         except Exception as err:
             self.logger.error(err)
 
@@ -131,32 +189,46 @@ class AE31:
             if self._data:
                 timestamp = datetime.now().strftime(self._file_timestamp_format)               
                 self.data_file = os.path.join(self.data_path, f"ae31-{timestamp}.csv")
-                if os.path.exists(self.data_file):
-                    mode = 'a'
-                    header = ''
-                else:
-                    mode = 'w'
-                    header = self.header
-                    self.logger.info(f"AE31, Reading data and writing to {self.data_path}/ae31-{timestamp}.csv")
-                
-                # open file and write to it
-                with open(file=self.data_file, mode=mode) as fh:
-                    fh.write(f"{header}{self._data}")
+
+                # keep the file open for as long as data go to the same file
+                if self.data_file != self._current_file:
+                    self._close_data_file()
+                    if os.path.exists(self.data_file):
+                        self._fh = open(file=self.data_file, mode='a', buffering=1 << 16)
+                    else:
+                        self._fh = open(file=self.data_file, mode='w', buffering=1 << 16)
+                        self._fh.write(self.header)
+                        self.logger.info(f"AE31, Reading data and writing to {self.data_path}/ae31-{timestamp}.csv")
+                    self._current_file = self.data_file
+
+                # flush, so the file is complete when staged
+                self._fh.write("".join(self._data))
+                self._fh.flush()
 
                 # reset self._data
-                self._data = str()
+                self._data = []
 
         except Exception as err:
             self.logger.error(err)
 
 
+    def _close_data_file(self):
+        """Flush and close the current data file, if any."""
+        if self._fh is not None:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._fh.close()
+            self._fh = None
+            self._current_file = None
+
+
     def _stage_file(self):
         """ Create zip file from self.data_file and stage archive.
         """
         try:
             if self.data_file:
                 archive = os.path.join(self.staging_path, os.path.basename(self.data_file).replace('.csv', '.zip'))
-                with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
                     zf.write(self.data_file, os.path.basename(self.data_file))
                     self.logger.info(f"file staged: {archive}")
 
@@ -218,24 +290,11 @@ class AE31:
         Returns:
             pl.DataFrame: dataframe with header
         """
-        cols = ["dtm","unknown","date","time","UV370","B470","G520","Y590","R660","IR880","IR950","flow",]# "bypass",]
-        cols += ["?370", "sens_zero_370","sens_beam_370","ref_zero_370","ref_beam_370","att_370", ]#"flow_370", "bypass_370",] 
-        cols += ["?470", "sens_zero_470","sens_beam_470","ref_zero_470","ref_beam_470","att_470", ]#"flow_470", "bypass_470",] 
-        cols += ["?520", "sens_zero_520","sens_beam_520","ref_zero_520","ref_beam_520","att_520", ]#"flow_520", "bypass_520",] 
-        cols += ["?590", "sens_zero_590","sens_beam_590","ref_zero_590","ref_beam_590","att_590", ]#"flow_590", "bypass_590",] 
-        cols += ["?660", "sens_zero_660","sens_beam_660","ref_zero_660","ref_beam_660","att_660", ]#"flow_660", "bypass_660",] 
-        cols += ["?880", "sens_zero_880","sens_beam_880","ref_zero_880","ref_beam_880","att_880", ]#"flow_880", "bypass_880",] 
-        cols += ["?950", "sens_zero_950","sens_beam_950","ref_zero_950","ref_beam_950","att_950", ]#"flow_950", "bypass_950",] 
-
         df = pl.DataFrame()
 
         try:
-            with open(file, "r") as fh:
-                content = fh.read().replace(" ", "").encode()
-
-            df = pl.read_csv(content, has_header=False)
-            df = df.cast({pl.Int64: pl.Float32, pl.Float64: pl.Float32})
-            df.columns = cols
+            # parse once with the final column names and types, whitespace around numbers is handled by polars
+            df = pl.read_csv(file, has_header=False, schema=_CSV_SCHEMA)
             df = df.with_columns(pl.col("dtm").str.to_datetime(time_unit='us', time_zone='UTC'),
                                 pl.col("date").str.to_date("%d-%b-%Y").dt.combine(pl.col("time").str.to_time("%H:%M")).alias("dtm_ae31"))
 
@@ -250,23 +309,23 @@ class AE31:
         Returns:
             pl.DataFrame: compiled data set
         """
-        df = pl.DataFrame()
+        frames = []
+        for file in glob.glob(os.path.join(self.data_path, '**', '*.csv'), recursive=True):
+            _ = self.csv_to_df(file)
+            if _ is None:
+                self.logger.error(f"{file} could not be appended.")
+            else:
+                frames.append(_)
+
+        # concatenate once, rather than re-copying the growing frame for every file
+        df = pl.concat(frames, how="diagonal_relaxed") if frames else pl.DataFrame()
+        if df.is_empty():
+            return df
 
-        for root, dirs, files in os.walk(self.data_path):
-            for file in files:
-                if df.is_empty():
-                    df = self.csv_to_df(os.path.join(root, file))
-                else:
-                    try:
-                        _ = self.csv_to_df(os.path.join(root, file))
-                        df = pl.concat([df, _], how="diagonal")
-                    except Exception as err:
-                        self.logger.error(f"{file} could not be appended. Error: {err}")
-                        pass
         if remove_duplicates:
             df = df.unique()
-        
-        df.sort(by=['dtm_ae31'])
+
+        df = df.sort(by=['dtm_ae31'])
 
         if archive:
             df.write_parquet(os.path.join(self.archive_path, 'ae31_nrb.parquet'))
@@ -1,17 +1,25 @@
+import calendar
+import concurrent.futures
 import logging
+import math
 import os
+import re
+import select
 import time
 import zipfile
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
 from typing import List, Tuple
 
 import numpy as np
 import polars as pl
-import schedule
 import serial
 
+from pydaq.utils.scheduler import PeriodicScheduler
 from pydaq.utils.utils import load_config, setup_logging
 
+# blank lines and blanks after separators in instrument responses
+_CLEAN_RE = re.compile(rb'\r\n\n|, ')
+
 
 class Aurora3000:
     def __init__(self, config: dict):
@@ -30,6 +38,7 @@ class Aurora3000:
             self.port = config['Aurora3000']['serial_port']
             self.baudrate = int(config['Aurora3000']['serial_baudrate'])
             self.timeout = float(config['Aurora3000']['serial_timeout'])
+            self._ser = None
             
             # configure data collection
             self.sampling_interval = int(config['Aurora3000']['sampling_interval'])
@@ -42,19 +51,41 @@ class Aurora3000:
             self.data_path = os.path.join(root, config['data'], config['Aurora3000']['data_path'])
             self.staging_path = os.path.join(root, config['staging'], config['Aurora3000']['staging_path'])
             self.remote_path = config['Aurora3000']['remote_path']
+            # data files go to yyyy/mm, or yyyy/mm/dd for sub-daily reporting
+            self._dir_format = os.path.join('%Y', '%m') if self.reporting_interval >= 1440 else os.path.join('%Y', '%m', '%d')
+            self._current_dir = None
+            if self.reporting_interval==10:
+                self._file_timestamp_format = '%Y%m%d%H%M'
+            elif self.reporting_interval==60:
+                self._file_timestamp_format = '%Y%m%d%H'
+            elif self.reporting_interval==1440:
+                self._file_timestamp_format = '%Y%m%d'
+            else:
+                self._file_timestamp_format = str()
            
             # configure file header
             self.header = 'dtm,ssp1,ssp2,ssp3,sbsp1,sbsp2,sbsp3,sample_temp,enclosure_temp,RH,pressure,major_state,DIO_state\n'
+            self._header_cols = self.header.strip().split(',')
+            n_cols = len(self._header_cols) - 1
 
             # store readings and timestamp
-            # initialize data response and datetime stamp           
-            self._instant_readings = []
+            # initialize data response and datetime stamp
+            # instant readings (every 5 s) go to a preallocated ring buffer, self._n counts readings since the last average
+            max_samples = math.ceil(self.sampling_interval * 60 / 5) + 2
+            self._instant_readings = np.empty((max_samples, n_cols), dtype=np.float64)
+            self._n = 0
             self._dio_states = []
             self._last_timestamp = None
-            self._data = str()
+            self._data_rows = []
             self._dtm = None
             self.data_file = str()
 
+            # saving and staging run on a single background thread, off the acquisition loop
+            self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="aurora3000-io")
+
+            # background scheduler, see setup_schedules
+            self._scheduler = None
+
         except serial.SerialException as err:
             self.logger.error(f"Serial communication error: {err}")
             pass
@@ -65,46 +96,90 @@ class Aurora3000:
 
     def setup_schedules(self):
         try:
+            self._scheduler = PeriodicScheduler(name="Aurora3000")
+
             # configure data acquisition
             # collect readings every 5 seconds
-            schedule.every(5).seconds.do(self.accumulate_instant_readings)
+            self._scheduler.every(5, 0, self.accumulate_instant_readings)
             # compute average every sampling_interval minute(s)
-            schedule.every(self.sampling_interval).minutes.at(':00').do(self.accumulate_averages)            
-            
+            self._scheduler.every(self.sampling_interval * 60, 0, self.accumulate_averages)
+
             # configure saving and staging schedules
-            if self.reporting_interval==10:
-                self._file_timestamp_format = '%Y%m%d%H%M'
-                minutes = [f"{self.reporting_interval*n:02}" for n in range(6) if self.reporting_interval*n < 6]
-                for minute in minutes:
-                    schedule.every(1).hour.at(f"{minute}:01").do(self._save_and_stage_data)
-            elif self.reporting_interval==60:
-                self._file_timestamp_format = '%Y%m%d%H'
-                schedule.every(1).hour.at('00:02').do(self._save_and_stage_data)
-            elif self.reporting_interval==1440:
-                self._file_timestamp_format = '%Y%m%d'
-                schedule.every(1).day.at('00:00:02').do(self._save_and_stage_data)
+            if self._file_timestamp_format:
+                self._scheduler.every(self.reporting_interval * 60, 2, self._save_and_stage_data)
 
             # configure archive
             # self.archive_path = os.path.join(root, config['Aurora3000']['archive'])
             # os.makedirs(self.archive_path, exist_ok=True)
 
+            self._scheduler.start()
 
         except Exception as err:
             self.logger.error(err)
 
 
+    def _open_serial(self) -> serial.Serial:
+        """Return the serial port, opening it on first use or after an error. The port is kept open between commands."""
+        if self._ser is None or not self._ser.is_open:
+            self._ser = serial.Serial(self.port, self.baudrate, 8, 'N', 1, self.timeout)
+            try:
+                # reduce the latency timer of USB-serial adapters (Linux only)
+                self._ser.set_low_latency_mode(True)
+            except (AttributeError, ValueError, OSError) as err:
+                self.logger.debug(f"Low latency mode not available on {self.port}: {err}")
+        return self._ser
+
+
+    def _close_serial(self):
+        """Close the serial port."""
+        if self._ser is not None:
+            self._ser.close()
+            self._ser = None
+
+
+    def close(self):
+        """Stop the background scheduler, wait for pending saves and close the serial port."""
+        if self._scheduler is not None:
+            self._scheduler.stop()
+            self._scheduler.join()
+        self._writer.shutdown(wait=True)
+        self._close_serial()
+
+
+    @staticmethod
+    def _wait_readable(ser: serial.Serial, timeout: float) -> bool:
+        """Wait up to timeout seconds for bytes at the serial port. Sleeps in the kernel where the port has a file descriptor."""
+        try:
+            readable, _, _ = select.select([ser.fileno()], [], [], timeout)
+            return bool(readable)
+        except (AttributeError, OSError, ValueError):
+            # no file descriptor (e.g., Windows)
+            pass
+        time.sleep(timeout)
+        return ser.in_waiting > 0
+
+
     def serial_comm(self, cmd: str, sep: str=',') -> str:
         try:
-            data = bytes()
-            with serial.Serial(self.port, self.baudrate, 8, 'N', 1, self.timeout) as ser:
-                ser.write(f"{cmd}\r".encode())
-                time.sleep(0.2)
-                while ser.in_waiting > 0:
-                    data += ser.read(1024)
-                    time.sleep(0.1)
-                data = data.decode("utf-8")
-                data = data.replace('\r\n\n', '\r\n').replace(", ", ",").replace(",", sep)
+            ser = self._open_serial()
+            ser.reset_input_buffer()
+            ser.write(f"{cmd}\r".encode())
+
+            # block until the first line arrives (or timeout), then collect any further lines of a multi-line response
+            data = bytearray(ser.read_until(b'\r\n'))
+            while data:
+                if ser.in_waiting:
+                    data += ser.read(ser.in_waiting)
+                elif not self._wait_readable(ser, 0.1):
+                    break
+            data = _CLEAN_RE.sub(lambda m: b'\r\n' if m.group(0) == b'\r\n\n' else b',', data).decode("utf-8")
+            if sep != ',':
+                data = data.translate(str.maketrans({',': sep}))
             return data
+        except serial.SerialException as err:
+            self.logger.error(f"SerialException: {err}")
+            # reopen on next call
+            self._close_serial()
         except Exception as err:
             self.logger.error(err)
 
@@ -137,35 +212,41 @@ class Aurora3000:
             self.logger.error(err)
 
 
-    def parse_current_data(self, reading: str) -> Tuple[datetime, np.ndarray]:
-        """Parses a comma-separated reading string into a datetime object and a numpy array of values."""
+    def parse_current_data(self, reading: str, out: np.ndarray=None) -> Tuple[datetime, np.ndarray]:
+        """Parses a comma-separated reading string into a datetime object and a numpy array of values.
+        If out is given, the values are written into it instead of a new array."""
         try:
-            parts = reading.split(',')
-            timestamp = datetime.strptime(parts[0], "%Y-%m-%d %H:%M:%S")
-            values = list(map(float, parts[1:-1]))
-            values.append(int(parts[-1], 16))    # Convert last element from hex to decimal
+            timestamp, payload = reading.split(',', 1)
+            numbers, dio_state = payload.rsplit(',', 1)
+            timestamp = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+            values = np.empty(self._instant_readings.shape[1], dtype=np.float64) if out is None else out
+            numeric = np.fromstring(numbers, sep=',')
+            if numeric.size != values.size - 1:
+                raise ValueError(f"Expected {values.size - 1} numeric values, got {numeric.size}: {reading}")
+            values[:-1] = numeric
+            values[-1] = int(dio_state, 16)    # Convert last element from hex to decimal
             return timestamp, values
         except Exception as err:
             self.logger.error(err)
 
 
     def _round_to_full_minute(self, timestamp: datetime) -> datetime:
-        """Rounds a datetime object to the nearest full minute."""
+        """Rounds a (naive) datetime object to the nearest full minute, using integer arithmetic on epoch seconds."""
         try:
-            if timestamp.second >= 30:
-                timestamp += timedelta(minutes=1)
-            return timestamp.replace(second=0, microsecond=0)
+            epoch_s = calendar.timegm(timestamp.timetuple())
+            return datetime.fromtimestamp((epoch_s + 30) // 60 * 60, tz=timezone.utc).replace(tzinfo=None)
         except Exception as err:
             self.logger.error(err)
 
 
     def accumulate_instant_readings(self) -> None:
-        """Collects a single reading and appends it to the self._instant_readings list."""
+        """Collects a single reading and writes it to the self._instant_readings ring buffer."""
         try:
             reading_str = self.get_current_data()  # Assuming get_readings returns a string
-            timestamp, values = self.parse_current_data(reading_str)
+            # parse straight into the next slot of the ring buffer; it only counts once parsing succeeded
+            timestamp, _ = self.parse_current_data(reading_str, out=self._instant_readings[self._n % len(self._instant_readings)])
             self._last_timestamp = timestamp
-            self._instant_readings.append(values)
+            self._n += 1
             self.logger.debug(reading_str)
         except Exception as err:
             self.logger.error(err)
@@ -173,25 +254,23 @@ class Aurora3000:
 
     def accumulate_averages(self) -> None:
         """
-        Computes the average of the collected self._instant_readings and appends the result to self._data.
+        Computes the average of the collected self._instant_readings and appends the result to self._data_rows.
         The timestamp for the average is the last timestamp of the instant readings, rounded to a full minute.
         """
         try:
-            if self._instant_readings:
-                # Stack self._instant_readings and compute mean across columns
-                readings_array = np.stack(self._instant_readings)
-                averages = np.mean(readings_array, axis=0)
+            if self._n:
+                # compute mean across columns of the filled part of the ring buffer
+                averages = self._instant_readings[:min(self._n, len(self._instant_readings))].mean(axis=0)
                 
                 # Round the last timestamp to the nearest full minute
                 dtm = self._round_to_full_minute(self._last_timestamp)
                 
                 # Clear the self._instant_readings for the next 1-minute collection
-                self._instant_readings = []
+                self._n = 0
                 
                 # Return the rounded timestamp followed by the averaged values
                 current_averages = ",".join(f"{avg:.3f}" for avg in averages)
-                # self._data = f"{self._data}{dtm.strftime('%Y-%m-%d %H:%M:%S')},{current_averages}\n"
-                self._data = f"{self._data}{dtm.isoformat(timespec='seconds')},{current_averages}\n"
+                self._data_rows.append(f"{dtm.isoformat(timespec='seconds')},{current_averages}\n")
                 self.logger.info(f"Aurora3000, {current_averages[:60]}[...]")
             return
 
@@ -199,36 +278,34 @@ class Aurora3000:
             self.logger.error(err)
 
 
-    def _save_data(self) -> None:
+    def _save_data(self, rows: List[str]=None) -> None:
+        """Write rows (default: self._data_rows) to the current data file and clear them."""
         try:
             data_file = str()
-            if self._data:
+            if rows is None:
+                rows = self._data_rows
+            if rows:
                 dtm = datetime.now()
 
-                # configure folders needed
-                yyyy = dtm.strftime('%Y')
-                mm = dtm.strftime('%m')
-                path = os.path.join(self.data_path, yyyy, mm)
-                if self.reporting_interval < 1440:
-                    path = os.path.join(path, dtm.strftime('%d'))
-                os.makedirs(path, exist_ok=True)
+                # configure folders needed, creating them only when the day (or month) rolls over
+                path = os.path.join(self.data_path, dtm.strftime(self._dir_format))
+                if path != self._current_dir:
+                    os.makedirs(path, exist_ok=True)
+                    self._current_dir = path
 
                 # create appropriate file path
-                timestamp = dtm.strftime(self._file_timestamp_format)               
+                timestamp = dtm.strftime(self._file_timestamp_format)
                 data_file = os.path.join(path, f"aurora3000-{timestamp}.csv")
 
-                # configure file mode, open file and write to it
-                if os.path.exists(self.data_file):
-                    with open(file=data_file, mode='a') as fh:
-                        fh.write(self._data)
-                else:
-                    with open(file=data_file, mode='w') as fh:
+                # append to the file, writing the header if it is new
+                with open(file=data_file, mode='a') as fh:
+                    if fh.tell() == 0:
                         fh.write(self.header)
-                        fh.write(self._data)
+                    fh.writelines(rows)
                 self.logger.info(f"file saved: {data_file}")
             
-                # reset self._data
-                self._data = str()
+                # reset rows
+                rows.clear()
 
             self.data_file = data_file
             return
@@ -245,7 +322,7 @@ class Aurora3000:
                 os.makedirs(self.staging_path, exist_ok=True)
 
                 archive = os.path.join(self.staging_path, os.path.basename(self.data_file).replace('.csv', '.zip'))
-                with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
                     zf.write(self.data_file, os.path.basename(self.data_file))
                     self.logger.info(f"file staged: {archive}")
 
@@ -254,7 +331,13 @@ class Aurora3000:
 
 
     def _save_and_stage_data(self):
-        self._save_data()
+        """Hand the accumulated rows to the background writer, which saves and then stages them."""
+        rows, self._data_rows = self._data_rows, []
+        self._writer.submit(self._save_and_stage_rows, rows)
+
+
+    def _save_and_stage_rows(self, rows: List[str]):
+        self._save_data(rows)
         self._stage_file()
 
 
@@ -263,10 +346,8 @@ class Aurora3000:
         Start the data collection process.
         """
         self.setup_schedules()
-
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        if self._scheduler is not None:
+            self._scheduler.join()
 
 
 if __name__ == "__main__":
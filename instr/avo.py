@@ -1,13 +1,38 @@
 """iQAIr Air Visual Outdoor (AVO) data download and parsing. Data are stored in .parquet files."""
 import os
 import datetime as datetime
-import json
+import glob
 import polars as pl
 import requests
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 keys = ['instant', 'hourly', 'daily', 'monthly']
 
+# shared session, keeps connections to the portal alive between downloads
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+# columns and types of flattened AVO records
+schema = {'ts': pl.String,
+          'co2': pl.Float32,
+          'pm1': pl.Float32,
+          'pr': pl.Float32,
+          'hm': pl.Float32,
+          'tp': pl.Float32,
+          'pm25_aqius': pl.Float32,
+          'pm25_aqicn': pl.Float32,
+          'pm25_conc': pl.Float32,
+          'pm10_aqius': pl.Float32,
+          'pm10_aqicn': pl.Float32,
+          'pm10_conc': pl.Float32}
+
 def download_data(url: str, validated: bool=False) -> dict:
     """
     Download AVO data from the portal. 
@@ -25,9 +50,9 @@ def download_data(url: str, validated: bool=False) -> dict:
     if validated:
         url = f"{url}/validated_data"
 
-    resp = requests.get(url)
+    resp = session.get(url, timeout=30)
     if resp.ok:
-        data = json.loads(resp.text)
+        data = orjson.loads(resp.content) if orjson is not None else resp.json()
 
     return data
 
@@ -43,14 +68,44 @@ def flatten_data(data: dict, parent_key='', sep='_') -> dict:
     Returns:
         dict: flattened dict
     """
-    items = []
-    for k, v in data.items():
-        new_key = f"{parent_key}{sep}{k}" if parent_key else k
-        if isinstance(v, dict):
-            items.extend(flatten_data(v, new_key, sep=sep).items())
+    flat = dict()
+    # iterate with an explicit stack of iterators, keeping the key order of a depth-first traversal
+    stack = [(parent_key, iter(data.items()))]
+    while stack:
+        prefix, items = stack[-1]
+        for k, v in items:
+            new_key = f"{prefix}{sep}{k}" if prefix else k
+            if isinstance(v, dict):
+                stack.append((new_key, iter(v.items())))
+                break
+            flat[new_key] = v
         else:
-            items.append((new_key, v))
-    return dict(items)
+            stack.pop()
+    return flat
+
+
+def entries_to_df(entries: list[dict]) -> pl.DataFrame:
+    """Build a DataFrame column by column from a list of (nested) AVO records.
+
+    Args:
+        entries (list[dict]): AVO records, e.g. data['historical']['hourly']
+
+    Returns:
+        pl.DataFrame: one row per record, columns in schema typed accordingly
+    """
+    columns = {key: [] for key in schema}
+    for i, entry in enumerate(entries):
+        for key, value in flatten_data(entry).items():
+            column = columns.get(key)
+            if column is None:
+                # column not seen in previous records
+                column = columns[key] = [None] * i
+            column.append(value)
+        # pad columns missing from this record
+        for column in columns.values():
+            if len(column) == i:
+                column.append(None)
+    return pl.DataFrame(columns, schema_overrides=schema, strict=False)
 
 
 def data_to_dfs(data: dict, file_path: str=str(),
@@ -62,7 +117,7 @@ def data_to_dfs(data: dict, file_path: str=str(),
     Args:
         data (dict): flattened dict of AVO data
         file_path (str, optional): dictionary path for data files. Defaults to str().
-        append (bool, optional): Should existing .parquet files be appended? Defaults to True.
+        append (bool, optional): Should new records be appended as a separate .parquet fragment of the period? Defaults to True.
         remove_duplicates (bool, optional): Should duplicates be removed? Defaults to True.
         staging (str, optional): Path to staging directory. Defaults to str() (= no staging).
 
@@ -71,6 +126,9 @@ def data_to_dfs(data: dict, file_path: str=str(),
     """
     if file_path:
         os.makedirs(file_path, exist_ok=True)
+    if staging:
+        staging = os.path.expanduser(staging)
+        os.makedirs(staging, exist_ok=True)
 
     # Extract name
     station = data['name'].lower().replace(' ', '_')
@@ -78,7 +136,7 @@ def data_to_dfs(data: dict, file_path: str=str(),
     result = dict()
     
     # Extract and flatten data into a list of several polars DataFrames
-    values = [pl.DataFrame([flatten_data(entry) for entry in data['historical'][key]]) for key in keys]
+    values = [entries_to_df(data['historical'][key]) for key in keys]
     
     result = dict(zip(keys, values))
 
@@ -87,74 +145,88 @@ def data_to_dfs(data: dict, file_path: str=str(),
             # Convert ts to pl.Datetime
             value = value.with_columns(pl.col("ts").str.to_datetime().alias('dtm'))
 
-            # cast all numerical columns to Float32 to reduce file size
+            # cast numerical columns not covered by schema to Float32 to reduce file size
             value = value.cast({pl.Int64: pl.Float32, pl.Float64: pl.Float32})
 
             # create file name
             format = "%Y%m" if key=="monthly" else "%Y%m%d"
-            dtm = datetime.datetime.now().strftime(format)
+            now = datetime.datetime.now()
+            dtm = now.strftime(format)
             file = os.path.join(file_path, f"{station}_avo_{key}-{dtm}.parquet")
-            
+
             if append:
-                if os.path.exists(file):
-                    value = pl.concat([pl.read_parquet(file), value], how='diagonal')
+                # write only new records into a fragment of the period, rather than rewriting the whole period file
+                fragments = os.path.join(file_path, f"{station}_avo_{key}-{dtm}*.parquet")
+                if glob.glob(fragments):
+                    existing = pl.scan_parquet(fragments).select('dtm').unique().collect()
+                    value = value.join(existing, on='dtm', how='anti')
+                    file = os.path.join(file_path, f"{station}_avo_{key}-{dtm}-{now.strftime('%H%M%S')}.parquet")
+            if value.is_empty():
+                continue
             if remove_duplicates:
-                value = value.unique()            
+                value = value.unique()
             value = value.sort(by=pl.col('dtm'))
             value.write_parquet(file)
 
             if staging:
-                os.makedirs(os.path.join(os.path.expanduser(staging)), exist_ok=True)
-                shutil.copy(src=file, dst=os.path.join(os.path.expanduser(staging), os.path.basename(file)))
+                shutil.copy(src=file, dst=os.path.join(staging, os.path.basename(file)))
 
     return station, result
 
 
 def download_multiple(urls: dict, file_path: str, staging: str=str()):
     all = list()
-    for key, url in urls.items():
-        print(f"retrieving from {key}")
-        data = download_data(url=url)
-        dfs = data_to_dfs(data=data, file_path=file_path, staging=staging)
-        if dfs:
-            all.append(dfs)
+    if not urls:
+        return all
+    # downloads are I/O-bound, fetch them concurrently and process them as they arrive
+    with ThreadPoolExecutor(max_workers=min(8, len(urls))) as ex:
+        futures = dict()
+        for key, url in urls.items():
+            print(f"retrieving from {key}")
+            futures[ex.submit(download_data, url=url)] = key
+        for future in as_completed(futures):
+            data = future.result()
+            dfs = data_to_dfs(data=data, file_path=file_path, staging=staging)
+            if dfs:
+                all.append(dfs)
     return all
 
 
 def compile_data(stations: list[str], source: str, target:str=str(), archive: bool=True) -> dict:
-    _ = dict(zip(keys, [pl.DataFrame(schema=dict([('ts', pl.String),
-                                                   ('co2', pl.Float32),
-                                                   ('pm1', pl.Float32),
-                                                   ('pr', pl.Float32),
-                                                   ('hm', pl.Float32),
-                                                   ('tp', pl.Float32),
-                                                   ('pm25_aqius', pl.Float32),
-                                                   ('pm25_aqicn', pl.Float32),
-                                                   ('pm25_conc', pl.Float32),
-                                                   ('pm10_aqius', pl.Float32),
-                                                   ('pm10_aqicn', pl.Float32),
-                                                   ('pm10_conc', pl.Float32),
-                                                   ('dtm', pl.Datetime(time_unit='us', time_zone='UTC'))]),
-                                                   )] * 4))
-
-    dfs = dict([(station, _) for station in stations])
+    empty = pl.LazyFrame(schema=dict(schema, dtm=pl.Datetime(time_unit='us', time_zone='UTC')))
+
+    # collect lazy scans per station and data type, read them all in one go further below
+    scans = dict([(station, dict([(key, [empty]) for key in keys])) for station in stations])
+    # column types per station and data type, a file that doesn't match is skipped, as it would fail the whole concat
+    dtypes = dict([(station, dict([(key, dict(empty.collect_schema())) for key in keys])) for station in stations])
 
     for root, dirs, files in os.walk(source):
         for file in files:
             if any(station in file for station in stations):
-                df = pl.read_parquet(os.path.join(root, file))
-                df = df.cast({pl.Int64: pl.Float32, pl.Float64: pl.Float32})
-
-                # Some files have ts converted to Datetime already, with or without a dtm column, so we need to make sure these files can be imported.
-                if df['ts'].dtype==pl.Datetime:
-                    df = df.rename({'ts': 'dtm'})
-                elif ('dtm' in df.columns and all(df['dtm'].is_null())) or ('dtm' not in df.columns):
-                    df = df.with_columns(pl.col("ts").str.to_datetime().alias('dtm'))
-                    df = df.drop('ts')
-
-                # rename columns, drop AQI columns
-                df = df.rename({'pm25_conc': 'pm25', 'pm10_conc': 'pm10'})            
-                df = df.drop(['pm25_aqius', 'pm25_aqicn', 'pm10_aqius', 'pm10_aqicn'])
+                try:
+                    lf = pl.scan_parquet(os.path.join(root, file))
+                    columns = lf.collect_schema()
+                    lf = lf.cast({pl.Int64: pl.Float32, pl.Float64: pl.Float32})
+
+                    # Some files have ts converted to Datetime already, with or without a dtm column, so we need to make sure these files can be imported.
+                    if columns['ts']==pl.Datetime:
+                        lf = lf.rename({'ts': 'dtm'})
+                    elif 'dtm' not in columns or columns['dtm']==pl.Null:
+                        lf = lf.with_columns(pl.col("ts").str.to_datetime(time_zone='UTC').alias('dtm'))
+                        lf = lf.drop('ts')
+
+                    # dtm in UTC, naive timestamps are taken as UTC
+                    dtm = lf.collect_schema()['dtm']
+                    if isinstance(dtm, pl.Datetime):
+                        if dtm.time_zone is None:
+                            lf = lf.with_columns(pl.col('dtm').dt.replace_time_zone('UTC'))
+                        else:
+                            lf = lf.with_columns(pl.col('dtm').dt.convert_time_zone('UTC'))
+                        lf = lf.with_columns(pl.col('dtm').cast(pl.Datetime(time_unit='us', time_zone='UTC')))
+                    lf_schema = lf.collect_schema()
+                except Exception as err:
+                    print(f"Failed to read '{file}'. Error: {err}")
+                    continue
 
                 basename_parts = file.split('.')[0].split('_')
                 
@@ -165,18 +237,36 @@ def compile_data(stations: list[str], source: str, target:str=str(), archive: bo
                 n = len(basename_parts)
                 station = "_".join(basename_parts[:(n-2)])
                 data_type = basename_parts[n-1].split('-')[0]
-                
-                # append and sort data by dtm, remove duplicates
+
                 try:
-                    dfs[station][data_type] = pl.concat([dfs[station][data_type], df], how = 'diagonal').sort(by='dtm').unique()
-                    # print(f"Appended data from '{file}'.")
+                    known = dtypes[station][data_type]
+                    mismatch = [col for col, dtype in lf_schema.items() if col in known and known[col] != dtype]
+                    if mismatch:
+                        print(f"Skipped '{file}', unexpected types of columns {mismatch}.")
+                        continue
+                    known.update(lf_schema)
+                    scans[station][data_type].append(lf)
                 except Exception as err:
                     print(f"Failed to append data from '{file}'. Error: {err}")
                     pass
 
-        if target:
-            for station, data in dfs.items():
-                for key, df in data.items():
-                    data[key].write_parquet(os.path.join(target, f"{station}_{key}_avo_compiled.parquet"))
+    dfs = dict()
+    for station, data in scans.items():
+        dfs[station] = dict()
+        for data_type, lfs in data.items():
+            # rename columns, drop AQI columns, remove duplicates and sort data by dtm
+            try:
+                dfs[station][data_type] = pl.concat(lfs, how='diagonal') \
+                    .rename({'pm25_conc': 'pm25', 'pm10_conc': 'pm10'}) \
+                    .drop(['pm25_aqius', 'pm25_aqicn', 'pm10_aqius', 'pm10_aqicn']) \
+                    .unique().sort(by='dtm').collect()
+            except Exception as err:
+                print(f"Failed to compile {data_type} data of '{station}'. Error: {err}")
+                dfs[station][data_type] = empty.collect()
+
+    if target:
+        for station, data in dfs.items():
+            for key, df in data.items():
+                df.write_parquet(os.path.join(target, f"{station}_{key}_avo_compiled.parquet"))
 
     return dfs
@@ -1,3 +1,27 @@
+import argparse
+import inspect
+import logging
+import math
+import os
+import re
+import socket
+import time
+import warnings
+from datetime import datetime
+from typing import Callable
+
+import numpy as np
+import schedule
+from pymodbus.client.tcp import ModbusTcpClient
+from pymodbus.exceptions import ConnectionException, ModbusException
+
+# keyword for the device address, depending on the pymodbus 3.x version ('slave' in earlier, 'device_id' in later releases);
+# pymodbus 2.x ('unit') has no pymodbus.client.tcp module and fails at the import above
+_UNIT_KW = next((kw for kw in ('device_id', 'slave')
+                 if kw in inspect.signature(ModbusTcpClient.read_holding_registers).parameters), None)
+if _UNIT_KW is None:
+    raise ImportError("Unsupported pymodbus version: read_holding_registers takes neither 'device_id' nor 'slave'.")
+
 # Instrument setup
 # > 'accessories' > IADS > change from 'remove volatile/moisture compensation' to OFF
 # > Control Panel >
@@ -59,10 +83,10 @@ device_status = {'Scope':0,
                  }
 
 
-from pymodbus.client.tcp import ModbusTcpClient
-from pymodbus.exceptions import ModbusException
-
 class ModbusTCPDriver:
+    # maximum number of holding registers per read request
+    MAX_REGISTERS = 125
+
     def __init__(self, ip: str, port: int = 11231, unit_id: int = 1):
         """
         Initialize a Modbus TCP connection.
@@ -83,6 +107,23 @@ class ModbusTCPDriver:
         self.connected = self.client.connect()
         if not self.connected:
             raise ConnectionError(f"Failed to connect to {self.ip}:{self.port}")
+        # send small request PDUs immediately rather than waiting on Nagle's algorithm
+        sock = self.client.socket
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    def _request(self, func, **kwargs):
+        """Send a request on the open connection, reconnecting once if the connection broke."""
+        try:
+            return func(**kwargs)
+        except ConnectionException:
+            self.close()
+            try:
+                self.connect()
+            except ConnectionError:
+                raise ConnectionException(f"Lost connection to {self.ip}:{self.port}")
+            return func(**kwargs)
 
     def close(self):
         """Close the TCP connection."""
@@ -92,7 +133,7 @@ class ModbusTCPDriver:
     def read_holding_registers(self, address: int, count: int):
         """Read holding registers starting at address."""
         try:
-            response = self.client.read_holding_registers(address=address, count=count, slave=self.unit_id)
+            response = self._request(self.client.read_holding_registers, address=address, count=count, **{_UNIT_KW: self.unit_id})
             if response.isError():
                 raise ModbusException(f"Error reading registers at {address}: {response}")
             return response.registers
@@ -100,10 +141,56 @@ class ModbusTCPDriver:
             print(f"Modbus error: {e}")
             return None
 
+    def read_many(self, ranges: list[tuple[int, int]]):
+        """
+        Read several ranges of holding registers with as few requests as possible.
+
+        Ranges that touch or overlap are merged into one request (at most 125 registers per read),
+        so that e.g. adjacent measurement groups cost a single round-trip. Ranges separated by a gap
+        are read separately, since the device rejects the whole request if an address in the gap
+        is not implemented. Ranges longer than 125 registers are split into several reads.
+
+        Args:
+            ranges (list[tuple[int, int]]): (address, count) of each range to read.
+
+        Returns:
+            list: register values per range, in the order given; None for ranges that failed.
+        """
+        # split each range into chunks of at most MAX_REGISTERS registers
+        chunks = {(address, count): [(start, min(self.MAX_REGISTERS, address + count - start))
+                                     for start in range(address, address + count, self.MAX_REGISTERS)]
+                  for address, count in ranges}
+
+        # merge touching or overlapping chunks into spans of at most MAX_REGISTERS registers
+        spans = []
+        for address, count in sorted(set(chunk for parts in chunks.values() for chunk in parts)):
+            if spans and address <= spans[-1][1] and max(spans[-1][1], address + count) - spans[-1][0] <= self.MAX_REGISTERS:
+                spans[-1][1] = max(spans[-1][1], address + count)
+            else:
+                spans.append([address, address + count])
+
+        registers = {}
+        for start, end in spans:
+            values = self.read_holding_registers(address=start, count=end - start)
+            if values is not None:
+                registers[start] = values
+
+        results = []
+        for address, count in ranges:
+            values = []
+            for chunk_address, chunk_count in chunks[(address, count)]:
+                start = next(span[0] for span in spans if span[0] <= chunk_address and chunk_address + chunk_count <= span[1])
+                if start not in registers:
+                    values = None
+                    break
+                values.extend(registers[start][chunk_address - start:chunk_address - start + chunk_count])
+            results.append(values)
+        return results
+
     def write_single_register(self, address: int, value: int):
         """Write a single value to one holding register."""
         try:
-            response = self.client.write_register(address=address, value=value, slave=self.unit_id)
+            response = self._request(self.client.write_register, address=address, value=value, **{_UNIT_KW: self.unit_id})
             if response.isError():
                 raise ModbusException(f"Error writing to register {address}: {response}")
             return True
@@ -119,19 +206,11 @@ class ModbusTCPDriver:
         self.close()
 
 
+# initial number of register columns in the collector buffer, grows if needed
+_MAX_KEYS = 64
 
-
-
-
-import os
-import re
-import time
-import logging
-import argparse
-import schedule
-from datetime import datetime
-from typing import Callable
-import polars as pl
+_SEND_VAL = re.compile(r"<sendVal (.+?)>")
+_PAIR = re.compile(r"(\d+)=([^;]+)")
 
 
 def setup_logging() -> None:
@@ -152,40 +231,46 @@ def collect_and_aggregate_polars(
     output_dir: str
 ) -> None:
     """
-    Collects instrument data for 1 minute, parses into a Polars DataFrame,
+    Collects instrument data for 1 minute, parses values per register,
     computes medians, and saves results to a timestamped CSV file.
     """
     logging.info("Collecting data...")
-    rows = []
+    # one row per sample, one column per register; NaN where a register was missing or invalid
+    buf = np.full((math.ceil(60 / max(interval_seconds, 1)) + 2, _MAX_KEYS), np.nan)
+    key_to_col: dict[str, int] = {}
+    row = 0
     end_time = time.time() + 60
 
     while time.time() < end_time:
         line = read_func()
-        match = re.search(r"<sendVal (.+?)>", line)
+        match = _SEND_VAL.search(line)
         if match:
-            payload = match.group(1)
-            parsed = {}
-            for item in payload.split(";"):
-                if "=" not in item:
-                    continue
-                key_str, value_str = item.split("=")
+            if row == buf.shape[0]:
+                buf = np.vstack([buf, np.full_like(buf, np.nan)])
+            for key_str, value_str in _PAIR.findall(match.group(1)):
                 try:
-                    key = f"v{int(key_str)}"
                     value = float(value_str)
-                    if not value_str.lower() == "nan":
-                        parsed[key] = value
                 except ValueError:
                     continue
-            if parsed:
-                rows.append(parsed)
+                key = f"v{int(key_str)}"
+                col = key_to_col.get(key)
+                if col is None:
+                    col = key_to_col[key] = len(key_to_col)
+                    if col == buf.shape[1]:
+                        buf = np.hstack([buf, np.full_like(buf, np.nan)])
+                buf[row, col] = value
+            row += 1
         time.sleep(interval_seconds)
 
-    if not rows:
+    if not key_to_col:
         logging.warning("No valid data collected in this interval.")
         return
 
-    df = pl.DataFrame(rows).fill_nan(None)
-    median_row = df.select(pl.all().median()).to_dict(as_series=False)
+    with warnings.catch_warnings():
+        # registers that only ever reported NaN have no median
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        medians = np.nanmedian(buf[:row, :len(key_to_col)], axis=0)
+    median_row = {key: None if np.isnan(medians[col]) else float(medians[col]) for key, col in key_to_col.items()}
 
     now = datetime.utcnow()
     timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
@@ -226,35 +311,10 @@ def main():
 
     while True:
         schedule.run_pending()
-        time.sleep(1)
+        # sleep until the next job is due (at most 1 s); a job due now runs right away
+        idle = schedule.idle_seconds()
+        time.sleep(1.0 if idle is None else min(max(idle, 0.0), 1.0))
 
 
 if __name__ == "__main__":
     main()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-if __name__ == "__main__":
-    ip = "192.168.0.216"  # your instrument's IP
-    port = 502            # default Modbus TCP port
-    unit_id = 1           # check your instrument docs
-
-    with ModbusTCPDriver(ip, port, unit_id) as driver:
-        registers = driver.read_holding_registers(address=0, count=10)
-        if registers is not None:
-            print("Register values:", registers)
-        else:
-            print("Failed to read registers")
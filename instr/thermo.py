@@ -4,20 +4,213 @@ Define a class TEI49I facilitating communication with a Thermo TEI49i instrument
 
 @author: joerg.klausen@meteoswiss.ch
 """
+import atexit
+import functools
 import logging
+import os
 import random
+import re
+import select
+import signal
 import socket
+import struct
+import sys
+import threading
 import time
 import zipfile
-from datetime import datetime
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import colorama
-import schedule
 import serial
 
 from utils.config_utils import get_instrument_param
-import serial
+from utils.scheduler import PeriodicScheduler
+
+try:
+    # libdeflate bindings, compress considerably faster than zlib at the same ratio
+    import deflate
+except ImportError:
+    deflate = None
+
+# ANSI colors need translating only on Windows consoles
+if sys.platform == 'win32':
+    colorama.init(autoreset=True)
+
+# color log messages on a console only, keep redirected output and log files plain
+_GREEN, _RED = (colorama.Fore.GREEN, colorama.Fore.RED) if sys.stdout.isatty() else ("", "")
+
+# maximum number of records returned by one lrec/srec request (C-Link: 'lrec xxxx yy', yy = 1..10)
+_MAX_RECORDS_PER_REQUEST = 10
+
+# timestamp of the data file names per reporting interval [min], one file per reporting interval
+_FILE_TIMESTAMP_FORMATS = {10: '%Y%m%d%H%M', 60: '%Y%m%d%H', 1440: '%Y%m%d'}
+
+# data files smaller than this are staged uncompressed
+_ZIP_STORED_MAX_SIZE = 64 * 1024
+
+# get_config commands whose replies change by themselves (the instrument clock), read anew on every get_config
+_VOLATILE_CONFIG = frozenset({'date', 'time'})
+
+
+# set once SIGTERM handling was checked, see _exit_on_sigterm
+_sigterm_checked = False
+
+
+def _exit_on_sigterm() -> None:
+    """
+    Turn SIGTERM into a regular interpreter exit, so that atexit handlers run and pending data is saved.
+
+    Done once per process, from the main thread, and only if no other handler was installed.
+    """
+    global _sigterm_checked
+    if _sigterm_checked or threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    _sigterm_checked = True
+
+
+@functools.lru_cache(maxsize=1)
+def _timestamp(second: int) -> str:
+    """Local time of the epoch second as 'YYYY-mm-dd HH:MM:SS', formatted once per second."""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+
+
+def _frame(instrument_id: int, cmd: str) -> bytes:
+    """Frame a command for the instrument: the instrument id byte, the command, CR."""
+    return bytes([instrument_id]) + cmd.encode() + b'\x0D'
+
+
+def _append_lines(path: Path, lines: list, header: str) -> bytes:
+    """
+    Append lines to path with a single write, preceded by header if the file is new or empty.
+
+    :return: the bytes written
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        payload = "".join(lines)
+        if os.fstat(fd).st_size == 0:
+            payload = header + payload
+        content = payload.encode()
+        os.write(fd, content)
+    finally:
+        os.close(fd)
+    return content
+
+
+# response to the o3 command, e.g. 'o3 30.781 ppb' or, with the echo removed by serial_comm/tcpip_comm,
+# '30.781 ppb': optional label, concentration, unit
+_O3_RESPONSE = re.compile(r"\s*(?:(\S+)\s+)?([-+.\deE]+)\s+(\S+)")
+
+
+def _parse_o3(response: str) -> tuple:
+    """Parse label ('o3' if absent), concentration and unit from an 'o3 30.781 ppb' or '30.781 ppb' response, None if the response is incomplete or garbled."""
+    match = _O3_RESPONSE.match(response) if isinstance(response, str) else None
+    if match is None:
+        return None
+    try:
+        return match.group(1) or 'o3', float(match.group(2)), match.group(3)
+    except ValueError:
+        return None
+
+
+def _wait_readable(ser: serial.Serial, timeout: float) -> bool:
+    """Wait up to timeout seconds for bytes at the serial port. Sleeps in the kernel where the port has a file descriptor."""
+    try:
+        readable, _, _ = select.select([ser.fileno()], [], [], timeout)
+        return bool(readable)
+    except (AttributeError, OSError, ValueError):
+        # no file descriptor (e.g., Windows)
+        pass
+    time.sleep(timeout)
+    return ser.in_waiting > 0
+
+
+def _set_low_latency(ser: serial.Serial, logger: logging.Logger) -> None:
+    """Reduce the latency timer of USB-serial adapters (ASYNC_LOW_LATENCY, Linux only). The port must be open."""
+    try:
+        ser.set_low_latency_mode(True)
+    except (AttributeError, ValueError, OSError) as err:
+        logger.debug(f"Low latency mode not available on {ser.port}: {err}")
+
+
+def _write_deflated_zip(archive: Path, name: str, content: bytes, mtime: float) -> None:
+    """Write content as the single member name of archive, deflated with libdeflate."""
+    compressed = deflate.deflate_compress(content, 6)
+    crc = zlib.crc32(content)
+    t = time.localtime(mtime)
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    fname = name.encode()
+
+    # local file header, data, central directory, end of central directory
+    local_header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0, zipfile.ZIP_DEFLATED, dos_time, dos_date,
+                               crc, len(compressed), len(content), len(fname), 0) + fname
+    central_directory = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, 0, zipfile.ZIP_DEFLATED, dos_time, dos_date,
+                                    crc, len(compressed), len(content), len(fname), 0, 0, 0, 0, 0, 0) + fname
+    end = struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, 1, 1, len(central_directory),
+                      len(local_header) + len(compressed), 0)
+    with open(archive, 'wb') as fh:
+        fh.write(b''.join((local_header, compressed, central_directory, end)))
+
+
+def _zip_to_staging(data_file: Path, archive: Path, content: bytes=None) -> bool:
+    """
+    Write data_file into archive, unless the archive is already up to date.
+
+    Small files are stored rather than deflated, the CPU spent compressing a few KB is not worth it.
+    Larger files are deflated with libdeflate if available, else with zlib.
+
+    :param content: the contents of data_file if still in memory, saves reading the file back. Ignored
+        unless it is the complete file, e.g. if the file existed before the content was written.
+    :return: True if the archive was (re)written
+    """
+    stat = data_file.stat()
+    # up to date if written after the last change of data_file (strictly, as mtimes may be as coarse as 2 s)
+    # and of the same size (rows may be appended within one mtime tick)
+    if archive.exists() and archive.stat().st_mtime > stat.st_mtime:
+        try:
+            with zipfile.ZipFile(archive) as zf:
+                if zf.getinfo(data_file.name).file_size == stat.st_size:
+                    return False
+        except (zipfile.BadZipFile, KeyError):
+            pass
+    if deflate is not None and stat.st_size >= _ZIP_STORED_MAX_SIZE:
+        if content is None or len(content) != stat.st_size:
+            content = data_file.read_bytes()
+        _write_deflated_zip(archive, data_file.name, content, stat.st_mtime)
+        return True
+    if stat.st_size < _ZIP_STORED_MAX_SIZE:
+        zf = zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_STORED)
+    else:
+        zf = zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+    with zf:
+        if content is not None and len(content) == stat.st_size:
+            info = zipfile.ZipInfo(data_file.name, date_time=time.localtime(stat.st_mtime)[:6])
+            info.compress_type = zf.compression
+            zf.writestr(info, content)
+        else:
+            zf.write(data_file, data_file.name)
+    return True
+
+
+def _read_response(ser: serial.Serial, idle: float=0.1) -> bytes:
+    """
+    Read a response from the serial port as soon as it arrives.
+
+    Blocks until the first line is terminated by CR (or the port timeout expires), then collects
+    further lines of a multi-line response until the port has been quiet for idle seconds.
+    """
+    rcvd = bytearray(ser.read_until(b'\r'))
+    while rcvd:
+        if ser.in_waiting:
+            rcvd += ser.read(ser.in_waiting)
+        elif not _wait_readable(ser, idle):
+            break
+    return bytes(rcvd)
 
 
 class Thermo49C:
@@ -49,14 +242,12 @@ class Thermo49C:
             - config['staging']['path']
             - config['staging']['zip']
         """
-        colorama.init(autoreset=True)
-
         try:
             self._name = name
             self._serial_number = config[name]['serial_number']
 
             # configure logging
-            _logger = f"{os.path.basename(config['logging']['file'])}".split('.')[0]
+            _logger = Path(config['logging']['file']).name.split('.')[0]
             self.logger = logging.getLogger(f"{_logger}.{__name__}")
             self.logger.info(f"[{self._name}] Initializing TEI49C (S/N: {self._serial_number})")
 
@@ -65,6 +256,8 @@ class Thermo49C:
             self._get_config = config[name]['get_config']
             self._set_config = config[name]['set_config']
             self._data_header = config[name]['data_header']
+            # framed bytes of commands sent repeatedly, see _frame
+            self._frames = {cmd: _frame(self._id, cmd) for cmd in ['lrec', 'O3', 'mode', *self._get_config, *self._set_config]}
 
             # configure serial port
             port = config[name]['port']
@@ -74,8 +267,7 @@ class Thermo49C:
                                         parity=config[port]['parity'],
                                         stopbits=config[port]['stopbits'],
                                         timeout=config[port]['timeout'])
-            if self._serial.is_open:
-                self._serial.close()
+            _set_low_latency(self._serial, self.logger)
 
             # sampling, aggregation, reporting/storage
             self.sampling_interval = config[name]['sampling_interval']
@@ -84,18 +276,31 @@ class Thermo49C:
                 raise ValueError('reporting_interval must be 10 or a multiple of 60 and less or equal to 1440 minutes.')
 
             # configure saving, staging and archiving
-            root = os.path.expanduser(config['root'])
-            self.data_path = os.path.join(root, config[name]['data_path'])
-            self.staging_path = os.path.join(root, config[name]['staging_path'])
+            root = Path(config['root']).expanduser()
+            self.data_path = root / config[name]['data_path']
+            self.staging_path = root / config[name]['staging_path']
             # self.archive_path = os.path.join(root, config[name]['archive'])
             self._file_to_stage = str()
+            self.data_file = None
+            self._data_file_content = None
             self._zip = config[name]['staging_zip']
 
             # configure remote transfer
             self.remote_path = config[name]['remote_path']
 
-            # initialize data response
-            self._data = str()
+            # initialize data response, one line per record
+            self._data = []
+
+            # configuration as last read from the instrument, see get_config
+            self._config_cache = None
+
+            # last valid O3 reading and its time.monotonic(), see get_cached_o3
+            self._last_o3 = None
+            self._last_o3_time = 0.0
+
+            # background scheduler, see setup_schedules
+            self._scheduler = None
+            self._file_timestamp_format = str()
 
             self.get_config()
             self.set_config()
@@ -107,45 +312,73 @@ class Thermo49C:
     def setup_schedules(self):
         try:
             # configure folders needed
-            os.makedirs(self.data_path, exist_ok=True)
-            os.makedirs(self.staging_path, exist_ok=True)
+            self.data_path.mkdir(parents=True, exist_ok=True)
+            self.staging_path.mkdir(parents=True, exist_ok=True)
             # os.makedirs(self.archive_path, exist_ok=True)
 
+            self._scheduler = PeriodicScheduler(name=self._name)
+
             # configure data acquisition schedule
-            schedule.every(self.sampling_interval).minutes.at(':00').do(self.accumulate_lrec)
+            self._scheduler.every(self.sampling_interval * 60, 0, self.accumulate_lrec)
 
             # configure saving and staging schedules
-            if self.reporting_interval==10:
-                self._file_timestamp_format = '%Y%m%d%H%M'
-                minutes = [f"{self.reporting_interval*n:02}" for n in range(6) if self.reporting_interval*n < 6]
-                for minute in minutes:
-                    schedule.every().hour.at(f"{minute}:01").do(self._save_and_stage_data)
-            elif self.reporting_interval==60:
-                self._file_timestamp_format = '%Y%m%d%H'
-                schedule.every().hour.at('00:01').do(self._save_and_stage_data)
-            elif self.reporting_interval==1440:
-                self._file_timestamp_format = '%Y%m%d'
-                schedule.every().day.at('00:00:01').do(self._save_and_stage_data)
+            self._file_timestamp_format = _FILE_TIMESTAMP_FORMATS.get(self.reporting_interval, str())
+            if self._file_timestamp_format:
+                self._scheduler.every(self.reporting_interval * 60, 1, self._save_and_stage_data)
+
+            self._scheduler.start()
+
+            # save the samples of the last, incomplete reporting interval on exit
+            atexit.unregister(self.close)
+            atexit.register(self.close)
+            _exit_on_sigterm()
 
         except Exception as err:
             self.logger.error(err)
 
 
+    def _stop_schedules(self):
+        """Cancel all pending events of the background scheduler and wait for a job in progress to finish,
+        so that it no longer uses the instrument connection or the data file."""
+        if self._scheduler is not None:
+            self._scheduler.stop()
+            self._scheduler.join()
+
+
+    def _open_serial(self) -> serial.Serial:
+        """Return the serial port, reopening it after an error. The port is kept open between commands."""
+        if not self._serial.is_open:
+            self._serial.open()
+            _set_low_latency(self._serial, self.logger)
+        return self._serial
+
+
+    def _close_serial(self):
+        """Close the serial port."""
+        if self._serial is not None and self._serial.is_open:
+            self._serial.close()
+
+
+    def close(self):
+        """Stop the background scheduler, save and stage pending data and close the serial port."""
+        self._stop_schedules()
+        if self._file_timestamp_format:
+            self._save_and_stage_data()
+        self._close_serial()
+
+
     def serial_comm(self, cmd: str) -> str:
         """
-        Send a command and retrieve the response. Assumes an open connection.
+        Send a command and retrieve the response. Opens the port if needed.
 
         :param cmd: command sent to instrument
         :return: response of instrument, decoded
         """
-        id = bytes([self._id])
         try:
-            rcvd = b''
-            self._serial.write(id + (f"{cmd}\x0D").encode())
-            time.sleep(0.5)
-            while self._serial.in_waiting > 0:
-                rcvd = rcvd + self._serial.read(1024)
-                time.sleep(0.1)
+            ser = self._open_serial()
+            ser.reset_input_buffer()
+            ser.write(self._frames.get(cmd) or _frame(self._id, cmd))
+            rcvd = _read_response(ser)
 
             rcvd = rcvd.decode()
             # remove checksum after and including the '*'
@@ -154,6 +387,11 @@ class Thermo49C:
             rcvd = rcvd.replace(cmd, "").strip()
             return rcvd
 
+        except serial.SerialException as err:
+            self.logger.error(f"SerialException: {err}")
+            # reopen on next call
+            self._close_serial()
+            return str()
         except Exception as err:
             self.logger.error(err)
             return str()
@@ -168,12 +406,18 @@ class Thermo49C:
         """
         cfg = []
         try:
-            self._serial.open()
+            if self._config_cache is not None:
+                # the settings are served from the cache, only the clock is read again
+                return [self.serial_comm(cmd) if cmd in _VOLATILE_CONFIG else response
+                        for cmd, response in zip(self._get_config, self._config_cache)]
+
             for cmd in self._get_config:
                 cfg.append(self.serial_comm(cmd))
-            self._serial.close()
-            self.logger.info(f"[{self._name}] Configuration is: {cfg}")
+            self.logger.info("[%s] Configuration is: %s", self._name, cfg)
 
+            # keep complete responses, the settings remain valid until set_config is called
+            if all(cfg):
+                self._config_cache = cfg
             return cfg
 
         except Exception as err:
@@ -197,6 +441,21 @@ class Thermo49C:
             self.logger.error(err)
 
 
+    def _wait_ready(self, timeout: float=1.0) -> bool:
+        """
+        Wait until the instrument answers again, e.g. after reconfiguration.
+
+        :param timeout: maximum time to wait in seconds
+        :return: True if the instrument responded in time
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.serial_comm('mode'):
+                return True
+            time.sleep(0.05)
+        return False
+
+
     def set_config(self) -> list:
         """
         Set configuration of instrument and optionally write to log.
@@ -204,16 +463,15 @@ class Thermo49C:
         :return new configuration as returned from instrument
         """
         self.logger.info(f"[{self._name}] .set_config")
+        self._config_cache = None
         cfg = []
         try:
-            self._serial.open()
             self.set_datetime()
             for cmd in self._set_config:
                 cfg.append(self.serial_comm(cmd))
-            self._serial.close()
-            time.sleep(1)
+            self._wait_ready()
 
-            self.logger.info(f"[{self._name}] Configuration set to: {cfg}")
+            self.logger.info("[%s] Configuration set to: %s", self._name, cfg)
 
             return cfg
 
@@ -227,15 +485,11 @@ class Thermo49C:
         Send command, retrieve response from instrument and append to self._data.
         """
         try:
-            dtm = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            if self._serial.is_open:
-                self._serial.close()
-            self._serial.open()
+            dtm = _timestamp(int(time.time()))
             _ = self.serial_comm('lrec')
-            self._serial.close()
 
-            self._data += f"{dtm} {_}\n"
-            self.logger.info(f"{self._name}: {_[:60]}[...]")
+            self._data.append(f"{dtm} {_}\n")
+            self.logger.info("%s: %.60s[...]", self._name, _)
 
             return
 
@@ -245,28 +499,20 @@ class Thermo49C:
 
     def _save_data(self) -> None:
         try:
-            data_file = str()
-            self.data_file = str()
+            data_file = None
+            self.data_file = None
+            self._data_file_content = None
             if self._data:
-                # create appropriate file name and write mode
-                timestamp = datetime.now().strftime(self._file_timestamp_format)
-                data_file = os.path.join(self.data_path, f"{self._name}-{timestamp}.dat")
-
-                # configure file mode, open file and write to it
-                if os.path.exists(self.data_file):
-                    mode = 'a'
-                    header = str()
-                else:
-                    mode = 'w'
-                    header = f"{self._data_header}\n"
+                # create appropriate file name
+                timestamp = time.strftime(self._file_timestamp_format)
+                data_file = self.data_path / f"{self._name}-{timestamp}.dat"
 
-                with open(file=data_file, mode=mode) as fh:
-                    fh.write(header)
-                    fh.write(self._data)
-                    self.logger.info(f"file saved: {data_file}")
+                # append to the file, writing the header if it is new; keep the bytes written for staging
+                self._data_file_content = _append_lines(data_file, self._data, header=f"{self._data_header}\n")
+                self.logger.info("file saved: %s", data_file)
 
                 # reset self._data
-                self._data = str()
+                self._data = []
 
             self.data_file = data_file
             return
@@ -280,10 +526,9 @@ class Thermo49C:
         """
         try:
             if self.data_file:
-                archive = os.path.join(self.staging_path, os.path.basename(self.data_file).replace('.dat', '.zip'))
-                with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-                    zf.write(self.data_file, os.path.basename(self.data_file))
-                    self.logger.info(f"file staged: {archive}")
+                archive = self.staging_path / self.data_file.with_suffix('.zip').name
+                if _zip_to_staging(self.data_file, archive, self._data_file_content):
+                    self.logger.info("file staged: %s", archive)
 
         except Exception as err:
             self.logger.error(err)
@@ -339,7 +584,7 @@ class Thermo49C:
     #                 if self._zip:
     #                     # create zip file
     #                     archive = os.path.join(root, "".join([os.path.basename(self._file_to_stage)[:-4], ".zip"]))
-    #                     with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+    #                     with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
     #                         zf.write(self._file_to_stage, os.path.basename(self._file_to_stage))
     #                 else:
     #                     shutil.copyfile(self._file_to_stage, os.path.join(root, os.path.basename(self._file_to_stage)))
@@ -351,11 +596,30 @@ class Thermo49C:
     #         self.logger.error(err)
 
 
+    def _cache_o3(self, response: str) -> tuple:
+        parsed = _parse_o3(response)
+        if parsed is not None:
+            self._last_o3 = parsed[1]
+            self._last_o3_time = time.monotonic()
+        return parsed
+
+
+    def get_cached_o3(self, max_age: float=60) -> float:
+        """
+        Return the last valid O3 reading without querying the instrument.
+
+        :param max_age: maximum age of the reading [s]
+        :return: O3 concentration, None if there is no reading younger than max_age
+        """
+        if self._last_o3 is not None and time.monotonic() - self._last_o3_time <= max_age:
+            return self._last_o3
+        return None
+
+
     def get_o3(self) -> str:
         try:
-            self._serial.open()
             o3 = self.serial_comm('O3')
-            self._serial.close()
+            self._cache_o3(o3)
             return o3
 
         except Exception as err:
@@ -365,11 +629,14 @@ class Thermo49C:
 
     def print_o3(self) -> None:
         try:
-            self._serial.open()
-            o3 = self.serial_comm('O3').split()
-            self._serial.close()
+            o3 = self.serial_comm('O3')
+            parsed = self._cache_o3(o3)
+            if parsed is None:
+                self.logger.warning(f"[{self._name}] invalid O3 response: '{o3}'")
+                return
 
-            self.logger.info(colorama.Fore.GREEN + f"[{self._name}] {o3[0].upper()} {str(float(o3[1]))} {o3[2]}")
+            label, value, unit = parsed
+            self.logger.info(_GREEN + "[%s] %s %s %s", self._name, label.upper(), value, unit)
 
         except Exception as err:
             self.logger.error(err)
@@ -383,57 +650,43 @@ class Thermo49C:
         :return str response as decoded string
         """
         try:
-            data = str()
-            data_file = str()
+            chunks = []
+            data_file = None
 
             # lrec and srec capacity of logger
             CMD = ["lrec", "srec"]
             CAPACITY = capacity
 
-            self.logger.info(f"[{self._name}] .get_all_rec (save={save})")
-
-            # close potentially open port
-            if self._serial.is_open:
-                self._serial.close()
+            self.logger.info("[%s] .get_all_rec (save=%s)", self._name, save)
 
             # retrieve data from instrument
             for i in [0, 1]:
                 index = CAPACITY[i]
-                retrieve = 10
                 if save:
                     # generate the datafile name
                     dtm = time.strftime('%Y%m%d%H%M%S')
-                    data_file = os.path.join(self.data_path,
-                                            f"{self._name}_all_{CMD[i]}-{dtm}.dat")
+                    data_file = self.data_path / f"{self._name}_all_{CMD[i]}-{dtm}.dat"
 
+                # collect responses in a list, joined once per record type
+                records = []
                 while index > 0:
-                    if index < 10:
-                        retrieve = index
+                    retrieve = min(index, _MAX_RECORDS_PER_REQUEST)
                     cmd = f"{CMD[i]} {str(index)} {str(retrieve)}"
                     self.logger.info(cmd)
-                    self._serial.open()
-                    data += f"{self.serial_comm(cmd)}\n"
-                    self._serial.close()
+                    records.append(f"{self.serial_comm(cmd)}\n")
 
-                    index = index - 10
+                    index = index - _MAX_RECORDS_PER_REQUEST
+                data = "".join(records)
+                chunks.append(data)
 
                 if save:
-                    if not os.path.exists(data_file):
-                        # if file doesn't exist, create and write header
-                        with open(data_file, "at") as fh:
-                            fh.write(f"{self._data_header}\n")
-                            fh.close()
-                    with open(data_file, "at") as fh:
-                        # add data to file
-                        fh.write(f"{data}\n")
-                        fh.close()
-
-                    # create zip file
-                    archive = os.path.join(data_file.replace(".dat", ".zip"))
-                    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as fh:
-                        fh.write(data_file, os.path.basename(data_file))
+                    # write header if file is new, then add data to file
+                    content = _append_lines(data_file, [data, "\n"], header=f"{self._data_header}\n")
 
-            return data
+                    # create zip file from the bytes just written
+                    _zip_to_staging(data_file, data_file.with_suffix(".zip"), content)
+
+            return "".join(chunks)
 
         except Exception as err:
             self.logger.error(err)
@@ -454,8 +707,6 @@ class Thermo49i:
 
             name (str): default name of instrument
         """
-        colorama.init(autoreset=True)
-
         try:
             # configure logging
             self.logger = logging.getLogger(f"Thermo49i:{name}")
@@ -469,6 +720,13 @@ class Thermo49i:
             self._get_config = get_instrument_param(config, name, 'get_config')
             self._set_config = get_instrument_param(config, name, 'set_config')
             self._get_data = get_instrument_param(config, name, 'get_data')
+            # retrieve the lrec buffer with a single request (firmware permitting), see get_all_lrec
+            self._bulk_lrec = bool(get_instrument_param(config, name, 'bulk_lrec'))
+            # send several commands in one write over TCP (firmware permitting), see _multi_cmd
+            self._pipeline = bool(get_instrument_param(config, name, 'pipeline'))
+            # framed bytes of commands sent repeatedly, see _frame
+            self._frames = {cmd: _frame(self._id, cmd) for cmd in [self._get_data, 'o3', 'mode', 'no of lrec', 'lrec format',
+                                                                   *self._get_config, *(self._set_config or [])]}
 
             self.logger.info(f"Initialize Thermo 49i (name: {self._name}  S/N: {self._serial_number})")
 
@@ -482,15 +740,14 @@ class Thermo49i:
                                             parity=config[port]['parity'],
                                             stopbits=config[port]['stopbits'],
                                             timeout=config[port]['timeout'])
-                if self._serial.is_open:
-                    self._serial.close()
-                self.logger.info(f"Serial port {port} successfully opened and closed.")
+                _set_low_latency(self._serial, self.logger)
+                self.logger.info(f"Serial port {port} successfully opened.")
             else:
+                self._serial = None
                 # configure tcp/ip
                 self._sockaddr = (get_instrument_param(config, name, 'socket')['host'],
                                 get_instrument_param(config, name, 'socket')['port'])
                 self._socktout = get_instrument_param(config, name, 'socket')['timeout']
-                self._socksleep = get_instrument_param(config, name, 'socket')['sleep']
 
             root = Path(config["paths"]["root"]).expanduser()
 
@@ -511,11 +768,33 @@ class Thermo49i:
             self.data_path.mkdir(parents=True, exist_ok=True)
             self.staging_path.mkdir(parents=True, exist_ok=True)
 
-            # initialize data response
-            self._data = str()
+            # initialize data response, one line per record
+            self._data = []
+
+            # configuration as last read from the instrument, see get_config
+            self._config_cache = None
+
+            # last valid O3 reading and its time.monotonic(), see get_cached_o3
+            self._last_o3 = None
+            self._last_o3_time = 0.0
+
+            # background scheduler, see setup_schedules
+            self._scheduler = None
+            self._file_timestamp_format = str()
+
+            # persistent TCP connection, see tcpip_comm
+            self._sock = None
+            # serializes commands and reconnects on the serial port or TCP connection, which are shared by the
+            # scheduler worker and other threads (e.g., a controller setting and reading O3 concurrently), so that
+            # each caller reads its own response; reentrant, see _multi_cmd
+            self._io_lock = threading.RLock()
+
+            # file descriptor of the data file currently written to, see _append_to_data_file
+            self._fd = None
+            self._current_file = None
 
-            # initiate _data_files_to_stage (set of paths)
-            self._data_files_to_stage = set()
+            # initiate _data_files_to_stage (paths, mapped to the bytes written to them since staging)
+            self._data_files_to_stage = dict()
 
         except Exception as err:
             self.logger.error(err)
@@ -527,95 +806,168 @@ class Thermo49i:
 
     def setup_schedules(self):
         try:
+            self._scheduler = PeriodicScheduler(name=self._name)
+
             # configure data acquisition schedule
-            schedule.every(int(self._sampling_interval)).minutes.at(':00').do(self.acquire_data)
-            schedule.every(int(self._sampling_interval)).minutes.at(':00').do(self.save_data)
+            self._scheduler.every(int(self._sampling_interval) * 60, 0, self._acquire_and_save_data)
 
             # configure saving and staging schedules
-            if self.reporting_interval==10:
-                self._file_timestamp_format = '%Y%m%d%H%M'
-                minutes = [f"{self.reporting_interval*n:02}" for n in range(6) if self.reporting_interval*n < 6]
-                for minute in minutes:
-                    schedule.every(1).hour.at(f"{minute}:01").do(self.stage_data_files)
-                self._file_timestamp_format = '%Y%m%d%H'
-                schedule.every(1).hour.at('00:01').do(self.stage_data_files)
-            elif self.reporting_interval==1440:
-                self._file_timestamp_format = '%Y%m%d'
-                schedule.every(1).day.at('00:00:01').do(self.stage_data_files)
+            self._file_timestamp_format = _FILE_TIMESTAMP_FORMATS.get(self.reporting_interval, str())
+            if self._file_timestamp_format:
+                self._scheduler.every(self.reporting_interval * 60, 1, self.stage_data_files)
+
+            self._scheduler.start()
+
+            # stage the files of the last, incomplete reporting interval on exit
+            atexit.unregister(self.close)
+            atexit.register(self.close)
+            _exit_on_sigterm()
 
         except Exception as err:
             self.logger.error(err)
 
 
+    def _stop_schedules(self):
+        """Cancel all pending events of the background scheduler and wait for a job in progress to finish,
+        so that it no longer uses the instrument connection or the data file."""
+        if self._scheduler is not None:
+            self._scheduler.stop()
+            self._scheduler.join()
+
+
+    def _acquire_and_save_data(self):
+        self.acquire_data()
+        self.save_data()
+
+
+    def _open_socket(self) -> socket.socket:
+        """Return the TCP connection to the instrument, connecting on first use or after an error. The connection is kept open between commands."""
+        if self._sock is None:
+            sock = socket.create_connection(self._sockaddr, timeout=self._socktout)
+            # send small commands immediately rather than waiting on Nagle's algorithm
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # notice an instrument that went away while the connection was idle between samples
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self._sock = sock
+        return self._sock
+
+
+    def _close_socket(self):
+        """Close the TCP connection."""
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
     def tcpip_comm(self, cmd: str) -> str:
         """
-        Send a command and retrieve the response. Assumes an open connection.
+        Send a command and retrieve the response. Connects if needed.
 
         :param cmd: command sent to instrument
         :return: response of instrument, decoded
         """
-        _id = bytes([self._id])
-        rcvd = b''
-        try:
-            # open socket connection as a client
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM, ) as s:
-                # connect to the server
-                s.settimeout(self._socktout)
-                s.connect(self._sockaddr)
-
-                # send data
-                s.sendall(_id + (f"{cmd}\x0D").encode())
-                time.sleep(self._socksleep)
-
-                # receive response
-                while True:
-                    data = s.recv(1024)
-                    rcvd = rcvd + data
-                    if b'\x00' in data:
+        with self._io_lock:
+            try:
+                frame = self._frames.get(cmd) or _frame(self._id, cmd)
+                # retry once on a fresh connection if the instrument closed the previous one
+                for attempt in range(2):
+                    s = self._open_socket()
+                    rcvd = bytearray()
+                    try:
+                        s.sendall(frame)
+
+                        # receive response as it arrives, up to the terminating NUL (or until the peer closes)
+                        while True:
+                            data = s.recv(4096)
+                            if not data:
+                                self._close_socket()
+                                break
+                            rcvd += data
+                            if b'\x00' in data:
+                                break
+                    except ConnectionError:
+                        self._close_socket()
+                        if attempt:
+                            raise
+                        continue
+                    if rcvd:
                         break
 
-            rcvd = rcvd.decode()
-            # remove checksum after and including the '*'
-            rcvd = rcvd.split("*")[0]
-            # remove echo before and including '\n'
-            # rcvd = rcvd.replace(f"{cmd}\n", "")
-            rcvd = rcvd.replace(cmd, "").strip()
+                rcvd = rcvd.decode()
+                # remove checksum after and including the '*'
+                rcvd = rcvd.split("*")[0]
+                # remove echo before and including '\n'
+                # rcvd = rcvd.replace(f"{cmd}\n", "")
+                rcvd = rcvd.replace(cmd, "").strip()
 
-            return rcvd
+                return rcvd
 
-        except Exception as err:
-            self.logger.error(err)
-            return err
+            except OSError as err:
+                # reconnect on next call
+                self._close_socket()
+                self.logger.error(err)
+                return err
+            except Exception as err:
+                self.logger.error(err)
+                return err
+
+
+    def _open_serial(self) -> serial.Serial:
+        """Return the serial port, reopening it after an error. The port is kept open between commands."""
+        if not self._serial.is_open:
+            self._serial.open()
+            _set_low_latency(self._serial, self.logger)
+        return self._serial
+
+
+    def _close_serial(self):
+        """Close the serial port."""
+        if self._serial is not None and self._serial.is_open:
+            self._serial.close()
+
+
+    def close(self):
+        """Stop the background scheduler, stage pending data files and close the serial port or TCP connection."""
+        self._stop_schedules()
+        self._close_data_file()
+        # one file at a time, close() runs at exit where no new threads can be started
+        self.stage_data_files(parallel=False)
+        with self._io_lock:
+            self._close_serial()
+            self._close_socket()
 
 
     def serial_comm(self, cmd: str, tidy=True) -> str:
         """
-        Send a command and retrieve the response. Assumes an open connection.
+        Send a command and retrieve the response. Opens the port if needed.
 
         :param cmd: command sent to instrument
         :param tidy: remove echo and checksum after '*'
         :return: response of instrument, decoded
         """
-        __id = bytes([self._id])
-        rcvd = b''
-        try:
-            self._serial.write(__id + (f"{cmd}\x0D").encode())
-            time.sleep(0.5)
-            while self._serial.in_waiting > 0:
-                rcvd = rcvd + self._serial.read(1024)
-                time.sleep(0.1)
-
-            rcvd = rcvd.decode()
-            # remove checksum after and including the '*'
-            rcvd = rcvd.split("*")[0]
-            # remove echo before and including '\n'
-            rcvd = rcvd.replace(cmd, "").strip()
-
-            return rcvd
-
-        except Exception as err:
-            self.logger.error(err)
-            return str()
+        with self._io_lock:
+            try:
+                ser = self._open_serial()
+                ser.reset_input_buffer()
+                ser.write(self._frames.get(cmd) or _frame(self._id, cmd))
+                rcvd = _read_response(ser)
+
+                rcvd = rcvd.decode()
+                # remove checksum after and including the '*'
+                rcvd = rcvd.split("*")[0]
+                # remove echo before and including '\n'
+                rcvd = rcvd.replace(cmd, "").strip()
+
+                return rcvd
+
+            except serial.SerialException as err:
+                self.logger.error(f"SerialException: {err}")
+                # reopen on next call
+                self._close_serial()
+                return str()
+            except Exception as err:
+                self.logger.error(err)
+                return str()
 
 
     def send_command(self, cmd: str) -> str:
@@ -626,10 +978,45 @@ class Thermo49i:
                 response = self.tcpip_comm(cmd)
             return response
         except Exception as err:
-            self.logger.error(colorama.Fore.RED + f"{err}")
+            self.logger.error(_RED + f"{err}")
             return str()
 
 
+    def _multi_cmd(self, cmds: list) -> list:
+        """
+        Send several commands and return their responses, in order.
+
+        If pipelining is enabled for a TCP connection, all commands are sent with a single write and the
+        NUL-terminated responses are read back from the stream. Otherwise, or if that fails, the commands
+        are sent one at a time.
+
+        :param cmds: commands sent to instrument
+        :return: responses of instrument, decoded
+        """
+        # hold the connection until all responses are read, see _io_lock
+        with self._io_lock:
+            if self._pipeline and not self._serial_com:
+                try:
+                    s = self._open_socket()
+                    s.sendall(b"".join(self._frames.get(cmd) or _frame(self._id, cmd) for cmd in cmds))
+                    rcvd = bytearray()
+                    while rcvd.count(b'\x00') < len(cmds):
+                        data = s.recv(4096)
+                        if not data:
+                            raise ConnectionError("connection closed by instrument")
+                        rcvd += data
+                    responses = rcvd.split(b'\x00')[:len(cmds)]
+                    # remove checksum after and including the '*', and the echo
+                    return [response.decode().split("*")[0].replace(cmd, "").strip() for cmd, response in zip(cmds, responses)]
+
+                except OSError as err:
+                    # discard whatever is left in the stream, then retry one command at a time
+                    self._close_socket()
+                    self.logger.warning("%s, pipelined commands failed (%s), sending one at a time.", self._name, err)
+
+            return [self.send_command(cmd) for cmd in cmds]
+
+
     def get_config(self) -> list:
         """
         Read current configuration of instrument and optionally write to log.
@@ -639,14 +1026,19 @@ class Thermo49i:
         """
         cfg = []
         try:
-            for cmd in self._get_config:
-                if self._serial_com:
-                    cfg.append(self.serial_comm(cmd))
-                else:
-                    cfg.append(self.tcpip_comm(cmd))
+            if self._config_cache is not None:
+                # the settings are served from the cache, only the clock is read again
+                volatile = [cmd for cmd in self._get_config if cmd in _VOLATILE_CONFIG]
+                fresh = dict(zip(volatile, self._multi_cmd(volatile))) if volatile else {}
+                return [fresh.get(cmd, response) for cmd, response in zip(self._get_config, self._config_cache)]
 
-            self.logger.info(f"{self._name}, Configuration read as: {cfg}")
+            cfg = self._multi_cmd(self._get_config)
 
+            self.logger.info("%s, Configuration read as: %s", self._name, cfg)
+
+            # keep complete responses, the settings remain valid until set_config is called
+            if all(isinstance(response, str) and response for response in cfg):
+                self._config_cache = cfg
             return cfg
 
         except Exception as err:
@@ -679,6 +1071,22 @@ class Thermo49i:
             self.logger.error(err)
 
 
+    def _wait_ready(self, timeout: float=1.0) -> bool:
+        """
+        Wait until the instrument answers again, e.g. after reconfiguration.
+
+        :param timeout: maximum time to wait in seconds
+        :return: True if the instrument responded in time
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            response = self.send_command('mode')
+            if isinstance(response, str) and response:
+                return True
+            time.sleep(0.05)
+        return False
+
+
     def set_config(self) -> list:
         """
         Set configuration of instrument and optionally write to log.
@@ -686,16 +1094,16 @@ class Thermo49i:
         :return (err, cfg) configuration set or errors, if any.
         """
         print("%s .set_config (name=%s)" % (time.strftime('%Y-%m-%d %H:%M:%S'), self._name))
+        self._config_cache = None
         cfg = []
         try:
-            for cmd in self._set_config:
-                if self._serial_com:
-                    cfg.append(self.serial_comm(cmd))
-                else:
-                    cfg.append(self.tcpip_comm(cmd))
-                time.sleep(1)
+            cfg = self._multi_cmd(self._set_config)
+            for cmd, response in zip(self._set_config, cfg):
+                if not (isinstance(response, str) and 'ok' in response):
+                    self.logger.warning("%s returned '%s' instead of 'ok'.", cmd, response)
+            self._wait_ready()
 
-            self.logger.info(f"{self._name}, Configuration set to: {cfg}")
+            self.logger.info("%s, Configuration set to: %s", self._name, cfg)
 
             return cfg
 
@@ -709,13 +1117,13 @@ class Thermo49i:
         Send command, retrieve response from instrument and append to self._data.
         """
         try:
-            dtm = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            dtm = _timestamp(int(time.time()))
             if self._serial_com:
                 _ = self.serial_comm(self._get_data)
             else:
                 _ = self.tcpip_comm(self._get_data)
-            self._data += f"{dtm} {_}\n"
-            self.logger.info(f"{self._name}, {_[:60]}[...]")
+            self._data.append(f"{dtm} {_}\n")
+            self.logger.info("%s, %.60s[...]", self._name, _)
 
             return
 
@@ -730,7 +1138,6 @@ class Thermo49i:
         :return str response as decoded string
         """
         try:
-            data = str()
             file = str()
 
             # retrieve numbers of lrec stored in buffer
@@ -743,7 +1150,7 @@ class Thermo49i:
 
             if save:
                 # generate the datafile name
-                dtm = datetime.now().strftime('%Y%m%d%H%M%S')
+                dtm = time.strftime('%Y%m%d%H%M%S')
                 file = self.data_path / f"{self._name}_all_lrec-{dtm}.dat"
 
             # get current lrec format, then set lrec format
@@ -754,21 +1161,22 @@ class Thermo49i:
                 lrec_format = self.tcpip_comm('lrec format')
                 _ = self.tcpip_comm('set lrec format 0')
             if not 'ok' in _:
-                self.logger.warning(f"{cmd} returned '{_}' instead of 'ok'.")
+                self.logger.warning("%s returned '%s' instead of 'ok'.", cmd, _)
 
-            # retrieve all lrec records stored in buffer
+            # retrieve all lrec records stored in buffer, collecting responses in a list joined once.
+            # C-Link limits lrec to 10 records per request, unless the firmware accepts more (bulk_lrec).
             index = no_of_lrec
-            retrieve = 10
+            per_request = no_of_lrec if self._bulk_lrec else _MAX_RECORDS_PER_REQUEST
+            records = []
 
             while index > 0:
-                if index < 10:
-                    retrieve = index
+                retrieve = min(index, per_request)
                 cmd = f"lrec {str(index)} {str(retrieve)}"
                 self.logger.info(cmd)
                 if self._serial_com:
-                    data += f"{self.serial_comm(cmd)}\n"
+                    records.append(f"{self.serial_comm(cmd)}\n")
                 else:
-                    data += f"{self.tcpip_comm(cmd)}\n"
+                    records.append(f"{self.tcpip_comm(cmd)}\n")
 
                 # remove all the extra info in the string returned
                 # 05:26 07-19-22 flags 0C100400 o3 30.781 hio3 0.000 cellai 50927 cellbi 51732 bncht 29.9 lmpt 53.1 o3lt 0.0 flowa 0.435 flowb 0.000 pres 493.7
@@ -784,18 +1192,15 @@ class Thermo49i:
                 # data = data.replace("pres ", "")
                 # data = data.replace("o3 ", "")
 
-                index = index - 10
+                index = index - per_request
+            data = "".join(records)
 
             if save:
                 # write .dat file
-                with open(file, "at", encoding='utf8') as fh:
-                    fh.write(f"{data}\n")
-                    fh.close()
+                content = _append_lines(file, [data, "\n"], header="")
 
-                # create zip file
-                archive = file.replace(".dat", ".zip")
-                with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as fh:
-                    fh.write(file, file.name)
+                # create zip file from the bytes just written
+                _zip_to_staging(file, file.with_suffix(".zip"), content)
 
             # restore lrec format
             if self._serial_com:
@@ -810,15 +1215,37 @@ class Thermo49i:
             return str()
 
 
+    def _cache_o3(self, response: str) -> tuple:
+        parsed = _parse_o3(response)
+        if parsed is not None:
+            self._last_o3 = parsed[1]
+            self._last_o3_time = time.monotonic()
+        return parsed
+
+
+    def get_cached_o3(self, max_age: float=60) -> float:
+        """
+        Return the last valid O3 reading without querying the instrument.
+
+        :param max_age: maximum age of the reading [s]
+        :return: O3 concentration, None if there is no reading younger than max_age
+        """
+        if self._last_o3 is not None and time.monotonic() - self._last_o3_time <= max_age:
+            return self._last_o3
+        return None
+
+
     def get_o3(self) -> str:
         try:
             if self.simulate:
                 return random.randint(0, 100)
             else:
                 if self._serial_com:
-                    return self.serial_comm('o3')
+                    o3 = self.serial_comm('o3')
                 else:
-                    return self.tcpip_comm('o3')
+                    o3 = self.tcpip_comm('o3')
+                self._cache_o3(o3)
+                return o3
 
         except Exception as err:
             self.logger.error(err)
@@ -828,13 +1255,19 @@ class Thermo49i:
     def print_o3(self) -> None:
         try:
             if self._serial_com:
-                o3 = self.serial_comm('o3').split()
+                o3 = self.serial_comm('o3')
             else:
-                o3 = self.tcpip_comm('o3').split()
-            self.logger.info(colorama.Fore.GREEN + f"{self._name}, {o3[0].upper()} {str(float(o3[1]))} {o3[2]}")
+                o3 = self.tcpip_comm('o3')
+            parsed = self._cache_o3(o3)
+            if parsed is None:
+                self.logger.warning(_RED + f"{self._name}, invalid O3 response: '{o3}'")
+                return
+
+            label, value, unit = parsed
+            self.logger.info(_GREEN + "%s, %s %s %s", self._name, label.upper(), value, unit)
 
         except Exception as err:
-            self.logger.error(colorama.Fore.RED + f"{err}")
+            self.logger.error(_RED + f"{err}")
 
 
     def set_o3(self, level: str) -> str:
@@ -857,40 +1290,75 @@ class Thermo49i:
             data_file = str()
             if self._data:
                 # create appropriate file name and write mode
-                timestamp = datetime.now().strftime(self._file_timestamp_format)
+                timestamp = time.strftime(self._file_timestamp_format)
                 data_file = self.data_path / f"{self._name}-{timestamp}.dat"
 
-                # configure file mode, open file and write to it
-                if data_file.exists():
-                    with open(file=data_file, mode='a') as fh:
-                        fh.write(self._data)
-                else:
-                    with open(file=data_file, mode='w') as fh:
-                        fh.write(self.header)
-                        fh.write(self._data)
-                self.logger.info(f"file saved: {data_file}")
+                # append to the file, writing the header if it is new; keep the bytes written for staging
+                content = self._append_to_data_file(data_file, self._data)
+                self.logger.info("file saved: %s", data_file)
 
                 # reset self._data
-                self._data = str()
+                self._data = []
 
-            self._data_files_to_stage.add(data_file)
+                self._data_files_to_stage.setdefault(data_file, []).append(content)
             return
 
         except Exception as err:
             self.logger.error(err)
 
 
-    def stage_data_files(self):
+    def _append_to_data_file(self, data_file: Path, lines: list) -> bytes:
+        """
+        Append lines to data_file with a single write, preceded by the header if the file is new or empty.
+
+        The file is kept open for as long as data go to the same file.
+
+        :return: the bytes written
+        """
+        if data_file != self._current_file:
+            self._close_data_file()
+            self._fd = os.open(data_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self._current_file = data_file
+            if os.fstat(self._fd).st_size == 0:
+                lines = [self.header, *lines]
+        content = "".join(lines).encode()
+        os.write(self._fd, content)
+        return content
+
+
+    def _close_data_file(self):
+        """Sync and close the current data file, if any."""
+        if self._fd is not None:
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = None
+            self._current_file = None
+
+
+    def _stage_data_file(self, data_file: Path, chunks: list) -> None:
+        archive = self.staging_path / data_file.with_suffix('.zip').name
+        if _zip_to_staging(data_file, archive, b"".join(chunks)):
+            self.logger.info("file staged: %s", archive)
+
+
+    def stage_data_files(self, parallel: bool=True):
         """ Create zip file from self._data_files_to_stage and stage archive.
+
+        Several files, e.g. after a restart, are compressed in parallel; zlib releases the GIL.
+
+        :param parallel: compress several files in parallel. Must be False at interpreter exit (atexit),
+            where no new threads can be started.
         """
         try:
             if self._data_files_to_stage:
-                for data_file in self._data_files_to_stage:
-                    archive = self.staging_path / data_file.name.replace('.dat', '.zip')
-                    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-                        zf.write(data_file, data_file.name)
-                        self.logger.info(f"file staged: {archive}")
-                self._data_files_to_stage = set()
+                if len(self._data_files_to_stage) == 1 or not parallel:
+                    for data_file, chunks in self._data_files_to_stage.items():
+                        self._stage_data_file(data_file, chunks)
+                else:
+                    with ThreadPoolExecutor(max_workers=min(len(self._data_files_to_stage), os.cpu_count() or 1)) as executor:
+                        # list() to re-raise exceptions of the workers
+                        list(executor.map(self._stage_data_file, self._data_files_to_stage.keys(), self._data_files_to_stage.values()))
+                self._data_files_to_stage = dict()
 
         except Exception as err:
             self.logger.error(err)
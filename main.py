@@ -5,6 +5,7 @@ import time
 from utils.instrument_loader import load_instrument
 from utils.logging_config import setup_logging
 from utils.sftp import SFTPClient
+from utils.utils import threaded
 
 def main():
     parser = argparse.ArgumentParser()
@@ -29,8 +30,9 @@ def main():
         instrument = load_instrument(class_path, name, params, simulate=simulate)
         instruments.append((instrument, params.get("poll_interval", 60)))
 
+    # poll each instrument on its own thread, so that a slow instrument does not delay the others
     for inst, interval in instruments:
-        schedule.every(interval).seconds.do(inst.acquire_data)
+        schedule.every(interval).seconds.do(threaded(inst.acquire_data))
 
     # setup sftp client
     sftp = SFTPClient(config=config)
@@ -38,7 +40,9 @@ def main():
     print("Running pydaq... (CTRL+C to exit)")
     while True:
         schedule.run_pending()
-        time.sleep(1)
+        # sleep until the next job is due (at most 1 s); a job due now runs right away
+        idle = schedule.idle_seconds()
+        time.sleep(1.0 if idle is None else min(max(idle, 0.0), 1.0))
 
 if __name__ == "__main__":
     main()
@@ -6,15 +6,17 @@ import instr.avo as avo
 from instr.thermo import Thermo49i
 from instr.aurora3000 import Aurora3000
 from utils.sftp import SFTPClient
-from utils.utils import load_config, setup_logging, seconds_to_next_n_minutes
+from utils.utils import load_config, setup_logging, seconds_to_next_n_minutes, threaded
 
 
 def main():
     # load configuation
     config = load_config(config_file='nrbdaq.yml')
 
+    root = os.path.expanduser(config['root'])
+
     # setup logging
-    logfile = os.path.join(os.path.expanduser(config['root']), config['logging']['file'])
+    logfile = os.path.join(root, config['logging']['file'])
     logger = setup_logging(file=logfile)
     logger.info("== Start NRBDAQ =============")
 
@@ -31,13 +33,15 @@ def main():
                                   interval=ae31.reporting_interval)
 
     # setup Nairobi AVO data download, staging and transfer
-    data_path = os.path.join(os.path.expanduser(config['root']), config['data'], config['AVO']['data_path'])
-    staging_path = os.path.join(os.path.expanduser(config['root']), config['staging'], config['AVO']['staging_path'])
+    data_path = os.path.join(root, config['data'], config['AVO']['data_path'])
+    staging_path = os.path.join(root, config['staging'], config['AVO']['staging_path'])
     remote_path = os.path.join(sftp.remote_path, config['AVO']['remote_path'])
     download_interval = config['AVO']['download_interval']
     hours = [f"{download_interval*n:02}:00" for n in range(23) if download_interval*n <= 23]
+    # download in the background, so that a slow server does not delay the file transfers
+    download_multiple = threaded(avo.download_multiple)
     for hr in hours:
-        schedule.every(1).day.at(hr).do(avo.download_multiple,
+        schedule.every(1).day.at(hr).do(download_multiple,
                                        urls={'url_nairobi': config['AVO']['urls']['url_nairobi']},
                                        file_path=data_path,
                                        staging=staging_path)
@@ -55,8 +59,9 @@ def main():
 
     # setup Aurora3000
     neph = Aurora3000(config=config)
-    neph.setup_schedules()
+    # query the instrument before the background scheduler starts using the serial port
     logger.info(f"get_instrument_id: {neph.get_instrument_id()}")
+    neph.setup_schedules()
     remote_path = os.path.join(sftp.remote_path, neph.remote_path)
     sftp.setup_transfer_schedules(local_path=neph.staging_path,
                                   remote_path=remote_path,
@@ -77,7 +82,9 @@ def main():
     # start jobs
     while True:
         schedule.run_pending()
-        time.sleep(1)
+        # sleep until the next job is due (at most 1 s); a job due now runs right away
+        idle = schedule.idle_seconds()
+        time.sleep(1.0 if idle is None else min(max(idle, 0.0), 1.0))
 
 
 if __name__ == "__main__":
@@ -1,11 +1,18 @@
 import os
 import polars as pl
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
+from pathlib import Path
 from pydaq.utils.utils import load_config
 from pydaq.utils.sftp import SFTPClient
 import pydaq.instr.avo as avo
 from pydaq.instr.ae31 import AE31
-from pydaq.instr.thermo import Thermo49i
+import pydaq.instr.thermo as thermo
+from pydaq.instr.thermo import Thermo49i, _parse_o3
+from pydaq.utils.scheduler import PeriodicScheduler
 
 config = load_config('nrbdaq.yml')
 
@@ -70,7 +77,74 @@ class TestThermo49i(unittest.TestCase):
     def test_init(self):
         thermo49i = Thermo49i(config=config)
 
-        self.assertEqual(thermo49i._data, str())
+        self.assertEqual(thermo49i._data, [])
+
+    def test_parse_o3(self):
+        # reply of a 49i to 'o3', as returned by serial_comm/tcpip_comm with checksum and echo removed
+        reply = "o3 30.781 ppb*0A1B".split("*")[0].replace("o3", "").strip()
+        self.assertEqual(_parse_o3(reply), ('o3', 30.781, 'ppb'))
+        self.assertEqual(_parse_o3("o3 30.781 ppb"), ('o3', 30.781, 'ppb'))
+        self.assertIsNone(_parse_o3("bad cmd"))
+
+class TestStaging(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.data_file = Path(self.tmp.name) / '49i-20240825.dat'
+        self.archive = Path(self.tmp.name) / '49i-20240825.zip'
+
+    @unittest.skipUnless(thermo.deflate is not None, "deflate is not installed")
+    def test_write_deflated_zip(self):
+        content = b"".join(b"pcdate pctime time date flags o3 %d\n" % i for i in range(10000))
+        thermo._write_deflated_zip(self.archive, self.data_file.name, content, time.time())
+
+        with zipfile.ZipFile(self.archive) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.getinfo(self.data_file.name).compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(zf.read(self.data_file.name), content)
+
+    def test_zip_to_staging_keeps_archive(self):
+        self.data_file.write_bytes(b"pcdate pctime o3\n")
+        past = time.time() - 10
+        os.utime(self.data_file, (past, past))
+        self.assertTrue(thermo._zip_to_staging(self.data_file, self.archive))
+        self.assertFalse(thermo._zip_to_staging(self.data_file, self.archive))
+
+        # a row appended after the archive was written
+        with open(self.data_file, 'ab') as fh:
+            fh.write(b"2024-08-25 12:00:00 30.781\n")
+        future = time.time() + 10
+        os.utime(self.data_file, (future, future))
+        self.assertTrue(thermo._zip_to_staging(self.data_file, self.archive))
+        with zipfile.ZipFile(self.archive) as zf:
+            self.assertEqual(zf.read(self.data_file.name), self.data_file.read_bytes())
+
+class TestPeriodicScheduler(unittest.TestCase):
+    def test_alignment(self):
+        scheduler = PeriodicScheduler(name="test")
+        scheduler.every(60, 7, lambda: None)
+        now = time.time()
+        event = scheduler._scheduler.queue[0]
+        scheduler.stop()
+
+        # events are queued on the monotonic clock
+        next_time = now + (event.time - time.monotonic())
+        self.assertGreater(next_time, now - 0.1)
+        self.assertLessEqual(next_time, now + 60.1)
+        remainder = (next_time + time.localtime(next_time).tm_gmtoff - 7) % 60
+        self.assertLess(min(remainder, 60 - remainder), 0.1)
+
+    def test_stop_join(self):
+        ran = threading.Event()
+        scheduler = PeriodicScheduler(name="test")
+        scheduler.every(1, 0, ran.set)
+        scheduler.start()
+        self.assertTrue(ran.wait(3))
+
+        scheduler.stop()
+        scheduler.join(timeout=3)
+        self.assertFalse(scheduler._worker.is_alive())
+        self.assertEqual(scheduler._scheduler.queue, [])
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
@@ -1,3 +1,5 @@
+# instruments list last searched and its entries by name, see get_instrument_param
+_index = (None, {})
 
 
 def get_instrument_param(config: dict, instrument_name: str, param_key: str) -> any:
@@ -12,8 +14,12 @@ def get_instrument_param(config: dict, instrument_name: str, param_key: str) ->
     Returns:
         Any: The value of the parameter, or None if not found.
     """
+    global _index
     instruments: list[dict] = config.get("instruments", [])
-    for instr in instruments:
-        if instr.get("name") == instrument_name:
-            return instr.get("params", {}).get(param_key, None)
-    return None
+    if _index[0] is not instruments:
+        # index by name once per config, the first entry wins as in a linear search
+        _index = (instruments, {instr.get("name"): instr for instr in reversed(instruments)})
+    instr = _index[1].get(instrument_name)
+    if instr is None:
+        return None
+    return instr.get("params", {}).get(param_key, None)
@@ -1,14 +1,21 @@
+import atexit
 import logging
-from datetime import datetime
-from logging.handlers import TimedRotatingFileHandler
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 from pathlib import Path
 
 class CustomTimedRotatingFileHandler(TimedRotatingFileHandler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._base = self.baseFilename[:-len(".log")] if self.baseFilename.endswith(".log") else self.baseFilename
+
     def rotation_filename(self, default_name: str) -> str:
-        # Override this to change the file naming convention
-        base = self.baseFilename.rstrip(".log")
-        date_suffix = datetime.now().strftime("%Y%m%d")
-        return f"{base}-{date_suffix}.log"
+        # Override this to change the file naming convention: name the rotated file by the day it covers,
+        # i.e. the start of the period that ends now (rolloverAt is advanced only after renaming)
+        start = self.rolloverAt - self.interval
+        date_suffix = time.strftime("%Y%m%d", time.gmtime(start) if self.utc else time.localtime(start))
+        return f"{self._base}-{date_suffix}.log"
 
 
 def setup_logging(config: dict, backup_count: int=50) -> logging.Logger:
@@ -58,9 +65,13 @@ def setup_logging(config: dict, backup_count: int=50) -> logging.Logger:
         file_handler.setFormatter(formatter)
         console_handler.setFormatter(formatter)
 
-        # Attach handlers
-        logger.addHandler(file_handler)
-        logger.addHandler(console_handler)
+        # Attach handlers behind a queue, so that logging calls don't wait on disk or console I/O;
+        # a background thread writes the records and is flushed at exit
+        log_queue = queue.Queue(-1)
+        listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(QueueHandler(log_queue))
 
         logger.info("== PYDAQ started =============")
 
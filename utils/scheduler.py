@@ -0,0 +1,94 @@
+import logging
+import sched
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicScheduler:
+    """
+    Run functions periodically on a background (daemon) thread, aligned to wall-clock boundaries,
+    so that the instrument I/O of one instrument does not hold up the others.
+
+    Usage:
+        scheduler = PeriodicScheduler(name="49i")
+        scheduler.every(60, 0, acquire)
+        scheduler.start()
+        ...
+        scheduler.stop()
+        scheduler.join()
+    """
+    def __init__(self, name: str=None) -> None:
+        """
+        Args:
+            name (str, optional): name of the worker thread. Defaults to None.
+        """
+        self._name = name
+        self._stopped = threading.Event()
+        # serializes re-arming events with stop(), so that no event is entered after stop() cancelled them
+        self._lock = threading.Lock()
+        # sleeps on the stop event, so that stop() wakes up the worker
+        self._scheduler = sched.scheduler(time.monotonic, self._stopped.wait)
+        self._worker = None
+
+
+    def every(self, period: int, offset: int, action) -> None:
+        """Schedule action at the next multiple of period seconds (since local midnight) plus offset seconds.
+        The event re-arms itself after each run, so the deadline is computed once per tick.
+
+        Boundaries are those of the local wall clock, like the file names (time.strftime) and the transfer
+        schedules (schedule.every().day.at()); e.g., a daily job runs after local midnight, not UTC midnight.
+
+        Args:
+            period (int): period in seconds
+            offset (int): delay in seconds after the period boundary
+            action (callable): function to run
+        """
+        def job():
+            try:
+                action()
+            except Exception:
+                # an error escaping sched.run would end the worker, and with it all other jobs
+                logger.exception("[%s] %s failed", self._name, getattr(action, '__name__', action))
+            self.every(period, offset, action)
+
+        with self._lock:
+            if self._stopped.is_set():
+                return
+            now = time.time()
+            # local time as seconds since the epoch, follows changes of the UTC offset (daylight saving time)
+            local_now = now + time.localtime(now).tm_gmtoff
+            next_time = (local_now // period + 1) * period + offset
+            if next_time - period > local_now:
+                # still before this period's offset
+                next_time -= period
+            self._scheduler.enter(next_time - local_now, 1, job)
+
+
+    def start(self) -> None:
+        """Start running the scheduled functions on the worker thread."""
+        self._worker = threading.Thread(target=self._scheduler.run, name=self._name, daemon=True)
+        self._worker.start()
+
+
+    def stop(self) -> None:
+        """Cancel all pending events. A function currently running is completed, see join."""
+        with self._lock:
+            self._stopped.set()
+            for event in self._scheduler.queue:
+                try:
+                    self._scheduler.cancel(event)
+                except ValueError:
+                    # event ran in the meantime
+                    pass
+
+
+    def join(self, timeout: float=None) -> None:
+        """Wait for the worker thread to finish, i.e., for the function currently running, after stop.
+
+        Args:
+            timeout (float, optional): maximum time to wait in seconds. Defaults to None (wait until finished).
+        """
+        if self._worker is not None and self._worker is not threading.current_thread():
+            self._worker.join(timeout)
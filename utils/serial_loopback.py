@@ -1,5 +1,4 @@
 import serial
-import time
 import argparse
 
 def loopback_test(port: str, baudrate: int, timeout: float):
@@ -20,12 +19,9 @@ def loopback_test(port: str, baudrate: int, timeout: float):
         ser.write(test_message.encode('ascii'))
         print(f"Sent: {test_message}")
 
-        # Give the device some time to respond
-        time.sleep(1)
-
-        # Read the response
-        if ser.in_waiting > 0:
-            response = ser.read(ser.in_waiting).decode('ascii')
+        # Read the response, returns as soon as the whole message is back or after timeout
+        response = ser.read(len(test_message)).decode('ascii', errors='replace')
+        if response:
             print(f"Received: {response}")
 
             # Check if the response matches the test message
@@ -7,11 +7,19 @@ Manage file transfer. Currently, sftp transfer to MeteoSwiss is supported.
 """
 import logging
 import os
+import queue
 import re
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import paramiko
 import schedule
 
+# path separators to clean up: Windows separators (single or escaped) with an optional leading '/' or '/.'
+_LOCAL_SEP = re.compile(r'(/?\.?\\){1,2}')
+_REMOTE_SEP = re.compile(r'(\\){1,2}')
+
 
 class SFTPClient:
     """
@@ -21,13 +29,21 @@ class SFTPClient:
     - is_alive():
     - list_local_files():
     - remote_item_exists():
+    - remote_items_exist(): check several items at once
     - list_remote_items():
     - setup_remote_folders():
     - put_file():
     - remove_remote_item():
     - transfer_files(): transfer files,  optionally removing files from source
+    - close(): close the connection
+
+    One SSH connection and SFTP session is opened on first use and reused by all methods, until close()
+    is called or the connection drops. Can be used as a context manager.
     """
 
+    # private keys by file, loaded (and decoded) once per process
+    _keys = dict()
+
     def __init__(self, config: dict):
         """
         Initialize the SFTPClient class with parameters from a configuration file.
@@ -47,11 +63,26 @@ class SFTPClient:
             self.schedule_logger.setLevel(level=logging.DEBUG)
             self.logger.info("Initialize SFTPClient")
 
+            # persistent connection, see _open_sftp
+            self._ssh = None
+            self._sftp = None
+            # guards (re)connecting and closing, so that concurrent callers don't both replace the connection
+            self._lock = threading.RLock()
+            # additional SFTP sessions on the same connection for parallel uploads, see _open_channels
+            self._channels = []
+            # remote directories known to exist, mapped to their full path, see setup_remote_path
+            self._remote_dirs = dict()
+
             # sftp connection settings
             self.host = config['sftp']['host']
+            self.port = config['sftp'].get('port', 22)
             self.usr = config['sftp']['usr']
-            self.key = paramiko.RSAKey.from_private_key_file(\
-                os.path.expanduser(config['sftp']['key']))
+            # number of files uploaded in parallel, each on its own SFTP session (bounded by sshd MaxSessions)
+            self.jobs = config['sftp'].get('jobs', 8)
+            key_file = os.path.expanduser(config['sftp']['key'])
+            if key_file not in SFTPClient._keys:
+                SFTPClient._keys[key_file] = paramiko.RSAKey.from_private_key_file(key_file)
+            self.key = SFTPClient._keys[key_file]
             
             # configure client proxy if needed
             # if config['sftp']['proxy']['socks5']:
@@ -72,6 +103,72 @@ class SFTPClient:
             self.logger.error(err)
 
 
+    def _open_sftp(self) -> paramiko.SFTPClient:
+        """Return the SFTP session, connecting on first use or after the connection dropped."""
+        with self._lock:
+            transport = self._ssh.get_transport() if self._ssh is not None else None
+            if self._sftp is None or transport is None or not transport.is_active():
+                self.close()
+                # send the small SFTP requests (stat, mkdir, close) immediately rather than waiting on Nagle's
+                # algorithm; buffer sizes are left to the kernel's autotuning
+                sock = socket.create_connection((self.host, self.port))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                ssh = paramiko.SSHClient()
+                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                try:
+                    # authenticate with the configured key only, without trying an agent or keys in ~/.ssh
+                    ssh.connect(hostname=self.host, port=self.port, username=self.usr, pkey=self.key, sock=sock,
+                                allow_agent=False, look_for_keys=False)
+                except Exception:
+                    ssh.close()
+                    sock.close()
+                    raise
+                # notice a dead connection between transfers
+                ssh.get_transport().set_keepalive(60)
+                self._ssh = ssh
+                self._sftp = ssh.open_sftp()
+            return self._sftp
+
+
+    def _open_channels(self, n: int) -> list:
+        """Return up to n SFTP sessions on the shared connection, opening more as needed and as the server permits."""
+        with self._lock:
+            channels = [self._open_sftp(), *self._channels]
+            while len(channels) < n:
+                try:
+                    channel = self._ssh.open_sftp()
+                except paramiko.SSHException as err:
+                    self.logger.debug(f"_open_channels: no more sessions after {len(channels)}: {err}")
+                    break
+                self._channels.append(channel)
+                channels.append(channel)
+            return channels[:n]
+
+
+    def close(self) -> None:
+        """Close the SFTP session and SSH connection, if open."""
+        with self._lock:
+            for channel in self._channels:
+                channel.close()
+            self._channels = []
+            if self._sftp is not None:
+                self._sftp.close()
+                self._sftp = None
+            if self._ssh is not None:
+                self._ssh.close()
+                self._ssh = None
+            # remote directories may change while not connected
+            self._remote_dirs.clear()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
     def is_alive(self) -> bool:
         """Test ssh connection to sftp server.
 
@@ -79,12 +176,7 @@ class SFTPClient:
             bool: [description]
         """
         try:
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-
-                with ssh.open_sftp() as sftp:
-                    sftp.close()
+            self._open_sftp().stat('.')
             return True
         except Exception as err:
             self.logger.error(err)
@@ -128,27 +220,54 @@ class SFTPClient:
         """
         try:
             remote_path = remote_path.replace('\\', '/').rstrip('/')
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-                with ssh.open_sftp() as sftp:
-                    try:
-                        sftp.stat(remote_path)
-                        return True
-                    except FileNotFoundError:
-                        return False
+            try:
+                self._open_sftp().stat(remote_path)
+                return True
+            except FileNotFoundError:
+                return False
         except Exception as err:
             self.logger.error(err)
             return False
         
 
+    def remote_items_exist(self, remote_paths: list) -> dict:
+        """Check on remote server if several items exist, stat'ing them in parallel on several SFTP sessions.
+
+        Args:
+            remote_paths (list): relative paths to remote items
+
+        Returns:
+            dict: True or False per remote path, empty if the check failed.
+        """
+        try:
+            if not remote_paths:
+                return dict()
+
+            channels = queue.Queue()
+            for channel in self._open_channels(min(self.jobs, len(remote_paths))):
+                channels.put(channel)
+
+            def exists(remote_path: str) -> bool:
+                # take a free session, paramiko's SFTP sessions can't serve requests from several threads at once
+                sftp = channels.get()
+                try:
+                    sftp.stat(remote_path.replace('\\', '/').rstrip('/'))
+                    return True
+                except FileNotFoundError:
+                    return False
+                finally:
+                    channels.put(sftp)
+
+            with ThreadPoolExecutor(max_workers=channels.qsize()) as executor:
+                return dict(zip(remote_paths, executor.map(exists, remote_paths)))
+        except Exception as err:
+            self.logger.error(err)
+            return dict()
+
+
     def list_remote_items(self, remote_path: str='.') -> list:
         try:
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-                with ssh.open_sftp() as sftp:
-                    return sftp.listdir(remote_path)
+            return self._open_sftp().listdir(remote_path)
 
         except Exception as err:
             self.logger.error(err)
@@ -168,31 +287,27 @@ class SFTPClient:
                 local_path = self.local_path
 
             # sanitize local_path
-            local_path = re.sub(r'(/?\.?\\){1,2}', '/', local_path)
+            local_path = _LOCAL_SEP.sub('/', local_path)
 
             if remote_path is str():
                 remote_path = self.remote_path
 
             # sanitize remote_path
-            remote_path = re.sub(r'(\\){1,2}', '/', remote_path)
+            remote_path = _REMOTE_SEP.sub('/', remote_path)
 
             self.logger.info(f"setup_remote_folders (local_path: {local_path}, remote_path: {remote_path})")
 
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-                with ssh.open_sftp() as sftp:
-                    # determine local directory structure, establish same structure on remote host
-                    for root, dirs, files in os.walk(local_path):
-                        root = re.sub(r'(/?\.?\\){1,2}', '/', root).replace(local_path, remote_path)
-                        self.logger.debug(f"root: {root}")
-                        try:
-                            sftp.mkdir(root, mode=16877)
-                        except OSError as err:
-                            # [todo] check if remote items exists, adapt error message accordingly ...
-                            self.logger.error(f"Could not create '{root}', error: {err}. Maybe path exists already?")
-                            pass
-                    sftp.close()
+            sftp = self._open_sftp()
+            # determine local directory structure, establish same structure on remote host
+            for root, dirs, files in os.walk(local_path):
+                root = _LOCAL_SEP.sub('/', root).replace(local_path, remote_path)
+                self.logger.debug(f"root: {root}")
+                try:
+                    sftp.mkdir(root, mode=16877)
+                except OSError as err:
+                    # [todo] check if remote items exists, adapt error message accordingly ...
+                    self.logger.error(f"Could not create '{root}', error: {err}. Maybe path exists already?")
+                    pass
 
         except Exception as err:
             self.logger.error(err)
@@ -209,15 +324,10 @@ class SFTPClient:
             if os.path.exists(local_path):
                 # remove the file name from remote_path in case it was appended, then add the file name
                 remote_path = os.path.join(os.path.dirname(remote_path), os.path.basename(local_path)).replace('\\', '/')
-                with paramiko.SSHClient() as ssh:
-                    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-                    with ssh.open_sftp() as sftp:
-                        attr = sftp.put(localpath=local_path,
-                                        remotepath=remote_path,
-                                        confirm=True)
-                        sftp.close()
-                    self.logger.info(f"put_file {local_path} > {remote_path}")
+                attr = self._open_sftp().put(localpath=local_path,
+                                             remotepath=remote_path,
+                                             confirm=True)
+                self.logger.info(f"put_file {local_path} > {remote_path}")
                 return attr
             else:
                 raise ValueError(f"local_path {local_path} does not exist.")
@@ -235,26 +345,23 @@ class SFTPClient:
         try:
             remote_path = remote_path.replace('\\', '/')
             if self.remote_item_exists(remote_path):
-                with paramiko.SSHClient() as ssh:
-                    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-                    with ssh.open_sftp() as sftp:
-                        try:
-                            if sftp.listdir(remote_path):                        
-                                # neither an empty directory, nor a file: do nothing
-                                self.logger.warning('Cannot remove non-empty directory. Provide full path to file to remove it, or empty the directory first.')
-                                return
-                            else:
-                                # remote path is an empty directory
-                                sftp.rmdir(remote_path)
-                        except:
-                            # remote_path is a file
-                            try:
-                                sftp.remove(remote_path)
-                            except Exception as err:
-                                self.logger.error(err)
-                        self.logger.info(f"remove_remote_item {remote_path}")
-                        sftp.close()
+                sftp = self._open_sftp()
+                try:
+                    if sftp.listdir(remote_path):
+                        # neither an empty directory, nor a file: do nothing
+                        self.logger.warning('Cannot remove non-empty directory. Provide full path to file to remove it, or empty the directory first.')
+                        return
+                    else:
+                        # remote path is an empty directory
+                        sftp.rmdir(remote_path)
+                        self._remote_dirs.clear()
+                except:
+                    # remote_path is a file
+                    try:
+                        sftp.remove(remote_path)
+                    except Exception as err:
+                        self.logger.error(err)
+                self.logger.info(f"remove_remote_item {remote_path}")
 
             else:
                 raise ValueError("remove_remote_item: remote_path does not exist.")
@@ -263,39 +370,45 @@ class SFTPClient:
 
 
     def setup_remote_path(self, remote_path: str) -> str:
-        """Create (and navigate to the leaf of) a remote path.
+        """Create a remote path, unless it is known to exist.
+
+        The working directory of the shared session is not changed, paths stay relative to the login directory.
 
         Args:
             remote_path (str): Remote path to create. NB: The last bit of the path is always interpreted as a directory
 
         Returns:
-            str: full path of current remote directory
+            str: full path of the remote directory
         """
         try:
             remote_path = remote_path.replace('\\', '/').replace('./', '')
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-                with ssh.open_sftp() as sftp:
-                    # create remote path if it doesn't exist and enter it        
-                    try:
-                        sftp.chdir(remote_path)
-                    except IOError:
-                        parts = remote_path.split("/")
-                        current_path = '.'
-                        for part in parts:
-                            if part:
-                                current_path = f"{current_path}/{part}"
+            cwd = self._remote_dirs.get(remote_path)
+            if cwd is None:
+                sftp = self._open_sftp()
+                # create remote path if it doesn't exist
+                try:
+                    sftp.stat(remote_path)
+                except IOError:
+                    parts = remote_path.split("/")
+                    current_path = '.'
+                    created = False
+                    for part in parts:
+                        if not part:
+                            continue
+                        current_path = f"{current_path}/{part}"
+                        # below a directory just created, nothing can exist yet
+                        if not created:
                             try:
-                                sftp.chdir(current_path)
+                                sftp.stat(current_path)
+                                continue
                             except IOError:
-                                sftp.mkdir(part)
-                                sftp.chdir(part)
-                                self.logger.debug(f"setup_remote_path: created {part}")
-                    cwd = sftp.getcwd()
-                    self.logger.debug(f"setup_remote_path: switched to {cwd}")
-                    if cwd is None:
-                        cwd = str()
+                                pass
+                        sftp.mkdir(current_path)
+                        created = True
+                        self.logger.debug(f"setup_remote_path: created {part}")
+                cwd = sftp.normalize(remote_path)
+                self._remote_dirs[remote_path] = cwd
+                self.logger.debug(f"setup_remote_path: {cwd}")
             return cwd
         except Exception as err:
             self.logger.error(f"setup_remote_path: {err}")
@@ -323,43 +436,92 @@ class SFTPClient:
             local_path = local_path.replace('\\', '/')
             remote_path = remote_path.replace('\\', '/')
 
-            with paramiko.SSHClient() as ssh:
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=self.host, username=self.usr, pkey=self.key)
-                with ssh.open_sftp() as sftp:
-                    # walk local directory structure, put file to remote location
-																
-                    top = local_path
-                    for root, dirs, files in os.walk(top=top):
-                        for file in files:
-                            local_file = os.path.join(root, file).replace('\\', '/').rstrip('/')
-                            parts = root.replace('\\', '/').replace(local_path, '').strip('/')
-                            remote_file = f"{remote_path}/{parts}/{file}"
-                            
-                            cwd = self.setup_remote_path(f"{remote_path}/{parts}")
-												 
-                            attr = sftp.put(localpath=local_file, remotepath=remote_file, confirm=True)
-                            self.logger.debug(f"put {local_file} > {remote_file}")
-                            self.transfered.append(file)
-
-                            if remove_on_success:
-																								  
-                                local_size = os.stat(local_file).st_size
-                                remote_size = attr.st_size
-                                if remote_size == local_size:
-                                    os.remove(local_file)
-                                else:
-                                    self.logger.warning(f"local file size: {local_size}, remote file: {remote_size} differ. Did not remove {local_file}.")
+            # walk local directory structure, set up remote folders once per folder
+            uploads = []
+            for root, dirs, files in os.walk(top=local_path):
+                parts = root.replace('\\', '/').replace(local_path, '').strip('/')
+                if files:
+                    self.setup_remote_path(f"{remote_path}/{parts}")
+                for file in files:
+                    local_file = os.path.join(root, file).replace('\\', '/').rstrip('/')
+                    uploads.append((local_file, f"{remote_path}/{parts}/{file}"))
+            if not uploads:
                 return
+
+            # put files to remote location, in parallel on several sessions if there are several files
+            channels = queue.Queue()
+            for channel in self._open_channels(min(self.jobs, len(uploads))):
+                channels.put(channel)
+            if channels.qsize() == 1:
+                results = [self._put(channels, local_file, remote_file, remove_on_success)
+                           for local_file, remote_file in uploads]
+            else:
+                with ThreadPoolExecutor(max_workers=channels.qsize()) as executor:
+                    # in order, re-raises the first error, if any
+                    results = list(executor.map(lambda upload: self._put(channels, *upload, remove_on_success), uploads))
+
+            for (local_file, remote_file), (transfered, warning) in zip(uploads, results):
+                if transfered:
+                    self.logger.debug(f"put {local_file} > {remote_file}")
+                    self.transfered.append(os.path.basename(local_file))
+                else:
+                    self.logger.debug(f"{remote_file} is up to date, skipped.")
+                if warning:
+                    self.logger.warning(warning)
+            return
                             
         except Exception as err:
+            # remote directories may have been removed meanwhile, check again next time
+            self._remote_dirs.clear()
             self.logger.error(f"transfer_files: {local_path} > {remote_path}: {err}")
 
 
+    def _put(self, channels: queue.Queue, local_file: str, remote_file: str, remove_on_success: bool) -> tuple:
+        """Put a file on the next free SFTP session of channels, optionally removing it locally if complete.
+
+        Files that are kept locally are transferred again on every run, unless the remote copy is up to date,
+        i.e. it has the same size and at least the modification time of the local file (which is copied to
+        the remote file on upload).
+
+        Runs on the worker threads of transfer_files, which collects the results.
+
+        Returns:
+            tuple: (True if the file was transferred, warning message or None)
+        """
+        sftp = channels.get()
+        try:
+            if not remove_on_success:
+                local = os.stat(local_file)
+                try:
+                    remote = sftp.stat(remote_file)
+                    if remote.st_size == local.st_size and remote.st_mtime >= int(local.st_mtime):
+                        return False, None
+                except FileNotFoundError:
+                    pass
+
+            # paramiko discards errors of pipelined writes, so the confirming stat() is the only proof the
+            # upload is complete; it costs a round-trip and is only needed before removing the local file
+            attr = sftp.put(localpath=local_file, remotepath=remote_file, confirm=remove_on_success)
+
+            if not remove_on_success:
+                sftp.utime(remote_file, (local.st_atime, local.st_mtime))
+        finally:
+            channels.put(sftp)
+
+        if remove_on_success:
+            local_size = os.stat(local_file).st_size
+            remote_size = attr.st_size
+            if remote_size == local_size:
+                os.remove(local_file)
+            else:
+                return True, f"local file size: {local_size}, remote file: {remote_size} differ. Did not remove {local_file}."
+        return True, None
+
+
     def setup_transfer_schedules(self, local_path: str, remote_path: str, remove_on_success: bool=True, interval: int=60):
         try:
             if interval==10:
-                minutes = [f"{interval*n:02}" for n in range(6) if interval*n < 6]
+                minutes = [f"{interval*n:02}" for n in range(60 // interval)]
                 for minute in minutes:
                     schedule.every(1).hour.at(f"{minute}:10").do(self.transfer_files, local_path, remote_path, remove_on_success)
             elif (interval % 60) == 0:
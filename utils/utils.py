@@ -1,21 +1,41 @@
 import configparser
 import logging
 import os
+import threading
 import time
+from typing import Callable
 
 import paho.mqtt.client as mqtt
 import yaml
 
+try:
+    # libyaml's C parser, several times faster than the pure-Python one
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
 
 class MQTTHandler(logging.Handler):
     def __init__(self, broker: str='localhost', port: int=1883, topic: str='logs'):
+        super().__init__()
         self.client = mqtt.Client()
+        self.client.reconnect_delay_set(min_delay=1, max_delay=120)
         self.client.connect(broker, port, 60)
+        # network traffic, keepalive and reconnects are handled on a background thread, publish() only queues
+        self.client.loop_start()
         self.topic = topic
 
     def emit(self, record):
-        log_entry = self.format(record)
-        self.client.publish(self.topic, log_entry)
+        try:
+            log_entry = self.format(record)
+            self.client.publish(self.topic, log_entry, qos=0, retain=False)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+        super().close()
 
 
 def load_config(config_file: str) -> configparser.ConfigParser:
@@ -31,7 +51,7 @@ def load_config(config_file: str) -> configparser.ConfigParser:
         config.read(config_file)
     elif extension == 'yaml' or extension == 'yml':
         with open(config_file, 'r') as fh:
-            config = yaml.safe_load(fh)
+            config = yaml.load(fh, Loader=_SafeLoader)
     else:
         print("Extension of config file not recognized!)")
     return config
@@ -76,15 +96,36 @@ def load_config(config_file: str) -> configparser.ConfigParser:
 #     return logger
 
 
-def seconds_to_next_n_minutes(n: int):
-    # Get the current time in seconds since the epoch
-    now = time.time()
+def threaded(job: Callable) -> Callable:
+    """
+    Wrap job to run on a daemon thread, so that a slow job does not hold up the others in the schedule loop.
+
+    A run is skipped if the previous run of the same wrapper is still in progress.
+
+    :param job: function to run
+    :return: function starting job in the background, to be passed to schedule
+    """
+    running = threading.Lock()
 
-    # Calculate minutes and seconds of the current time
-    minutes = int(now // 60) % 60
-    seconds = int(now % 60)
+    def run(*args, **kwargs):
+        if not running.acquire(blocking=False):
+            logging.getLogger(__name__).warning(f"{getattr(job, '__name__', job)} still running, skipped.")
+            return
+
+        def target():
+            try:
+                job(*args, **kwargs)
+            finally:
+                running.release()
+
+        threading.Thread(target=target, name=getattr(job, '__name__', None), daemon=True).start()
+
+    return run
+
+
+def seconds_to_next_n_minutes(n: int):
+    # Seconds since the start of the current hour, past the last n-minute mark (marks are aligned to the hour)
+    elapsed = int(time.time()) % 3600 % (n * 60)
 
     # Calculate remaining time to the next n-minute mark
-    minutes_to_next_n_minutes = n - (minutes % n)
-    remaining_seconds = (minutes_to_next_n_minutes * 60) - seconds
-    return remaining_seconds
+    return n * 60 - elapsed